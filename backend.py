@@ -5,40 +5,49 @@ https://github.com/ffnord/ffmap-backend
 """
 import argparse
 import json
+import logging
 import os
+import resource
+import signal
 import sys
+import threading
+import time
+from contextlib import ExitStack
 from datetime import datetime
 
-import networkx as nx
-from networkx.readwrite import json_graph
-
 from lib import graph, nodes
 from lib.alfred import Alfred
 from lib.batman import Batman
+from lib.changes import ChangeFeed
+from lib.collect import collect
+from lib.export import (IndexWriter, NodelistWriter, NodesWriter, dump_graph,
+                        export_nodes)
+from lib.ffmapd3 import export_ffmap_d3
 from lib.rrddb import RRD
-from lib.nodelist import export_nodelist
+from lib.rrdtool import RRDCached, RRDToolPipe
+from lib.nodestore import NodeStore
+from lib.publish import Publisher
+from lib.shards import export_shards
+from lib.snapshot import load_snapshot, save_snapshot
+from lib.tiles import TileIndex
 from lib.validate import validate_nodeinfos
 
 NODES_VERSION = 1
 GRAPH_VERSION = 1
 
+log = logging.getLogger('ffmap-backend')
 
-def main(params):
-    os.makedirs(params['dest_dir'], exist_ok=True)
 
-    nodes_fn = os.path.join(params['dest_dir'], 'nodes.json')
-    graph_fn = os.path.join(params['dest_dir'], 'graph.json')
-    nodelist_fn = os.path.join(params['dest_dir'], 'nodelist.json')
-
-    now = datetime.utcnow().replace(microsecond=0)
-
-    # parse mesh param and instantiate Alfred/Batman instances
+def parse_mesh(mesh):
+    """
+    Instantiate Alfred/Batman pairs for the given --mesh values.
+    """
     alfred_instances = []
     batman_instances = []
-    for value in params['mesh']:
+    for value in mesh:
         # (1) only batman-adv if, no alfred sock
         if ':' not in value:
-            if len(params['mesh']) > 1:
+            if len(mesh) > 1:
                 raise ValueError(
                     'Multiple mesh interfaces require the use of '
                     'alfred socket paths.')
@@ -56,106 +65,326 @@ def main(params):
                     'Unparseable value "{0}" in --mesh parameter.'.
                     format(value))
 
-    # read nodedb state from node.json
-    try:
-        with open(nodes_fn, 'r') as nodedb_handle:
-            nodedb = json.load(nodedb_handle)
-    except (IOError, ValueError):
-        nodedb = {'nodes': dict()}
+    return alfred_instances, batman_instances
+
+
+def load_nodedb(nodes_fn, snapshot_fn=None):
+    started = time.monotonic()
+
+    # the snapshot of nodes.json loads faster, if it is up to date
+    nodedb = None
+    if snapshot_fn is not None:
+        nodedb = load_snapshot(snapshot_fn, nodes_fn)
+        source = snapshot_fn
+
+    if nodedb is None:
+        # read nodedb state from node.json
+        source = nodes_fn
+        try:
+            with open(nodes_fn, 'r') as nodedb_handle:
+                nodedb = json.load(nodedb_handle)
+        except (IOError, ValueError):
+            nodedb = {'nodes': dict()}
+
+        # flush nodedb if it uses the old format
+        if 'links' in nodedb:
+            nodedb = {'nodes': dict()}
+        nodedb['nodes'] = nodes.load_nodes(nodedb['nodes'])
+
+    log.info('loaded %d nodes from %s in %.3fs, peak RSS %.1f MB',
+             len(nodedb['nodes']), source, time.monotonic() - started,
+             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    return nodedb
 
-    # flush nodedb if it uses the old format
-    if 'links' in nodedb:
-        nodedb = {'nodes': dict()}
 
+def load_aliases(filenames):
+    aliases = []
+    for filename in filenames:
+        with open(filename, 'r') as f:
+            aliases.append(validate_nodeinfos(json.load(f)))
+
+    return aliases
+
+
+def update(params, nodedb, macs, aliases,
+           alfred_instances, batman_instances, now, store=None):
+    """
+    Run one collection cycle, updating nodedb in place and saving its nodes
+    to store, if given.
+
+    Returns the BatadvGraph built from this cycle's vis data.
+    """
     # set version we're going to output
     nodedb['version'] = NODES_VERSION
 
     # update timestamp and assume all nodes are offline
     nodedb['timestamp'] = now.isoformat()
     for node_id, node in nodedb['nodes'].items():
-        node['flags']['online'] = False
+        node.online = False
 
-    # integrate alfred nodeinfo
-    for alfred in alfred_instances:
-        nodeinfo = validate_nodeinfos(alfred.nodeinfo())
-        nodes.import_nodeinfo(nodedb['nodes'], nodeinfo,
-                              now, assume_online=True)
+    # run all alfred and batman-adv commands at once
+    alfred_data, mesh_info = collect(alfred_instances, batman_instances,
+                                     params['workers'])
 
-    # integrate static aliases data
-    for aliases in params['aliases']:
-        with open(aliases, 'r') as f:
-            nodeinfo = validate_nodeinfos(json.load(f))
-            nodes.import_nodeinfo(nodedb['nodes'], nodeinfo,
-                                  now, assume_online=False)
+    # integrate alfred nodeinfo, then static aliases data
+    sources = [(validate_nodeinfos(nodeinfo), True)
+               for nodeinfo, _ in alfred_data]
+    sources.extend((nodeinfo, False) for nodeinfo in aliases)
+    nodes.import_nodeinfo(nodedb['nodes'], macs, sources, now)
 
     nodes.reset_statistics(nodedb['nodes'])
-    for alfred in alfred_instances:
-        nodes.import_statistics(nodedb['nodes'], alfred.statistics())
-
-    # acquire gwl and visdata for each batman instance
-    mesh_info = []
-    for batman in batman_instances:
-        vd = batman.vis_data()
-        gwl = batman.gateway_list()
-
-        mesh_info.append((vd, gwl))
+    for _, statistics in alfred_data:
+        nodes.import_statistics(nodedb['nodes'], macs, statistics)
 
     # update nodedb from batman-adv data
     for vd, gwl in mesh_info:
-        nodes.import_mesh_ifs_vis_data(nodedb['nodes'], vd)
-        nodes.import_vis_clientcount(nodedb['nodes'], vd)
-        nodes.mark_vis_data_online(nodedb['nodes'], vd, now)
-        nodes.mark_gateways(nodedb['nodes'], gwl)
+        nodes.import_mesh_ifs_vis_data(nodedb['nodes'], macs, vd)
+        nodes.import_vis_clientcount(nodedb['nodes'], macs, vd)
+        nodes.mark_vis_data_online(nodedb['nodes'], macs, vd, now)
+        nodes.mark_gateways(nodedb['nodes'], macs, gwl)
 
     # clear the nodedb from nodes that have not been online in $prune days
     if params['prune']:
-        nodes.prune_nodes(nodedb['nodes'], now, params['prune'])
+        if store is not None:
+            store.prune(nodedb['nodes'], macs, now, params['prune'])
+        else:
+            nodes.prune_nodes(nodedb['nodes'], macs, now, params['prune'])
 
-    # build nxnetworks graph from nodedb and visdata
-    batadv_graph = nx.DiGraph()
-    for vd, gwl in mesh_info:
-        graph.import_vis_data(batadv_graph, nodedb['nodes'], vd)
+    if store is not None:
+        log.info('saved %d changed nodes', store.save(nodedb['nodes']))
 
-    # force mac addresses to be vpn-link only (like gateways for example)
-    if params['vpn']:
-        graph.mark_vpn(batadv_graph, frozenset(params['vpn']))
+    # build graph from nodedb and visdata
+    batadv_graph = graph.BatadvGraph()
+    for vd, gwl in mesh_info:
+        batadv_graph.import_vis_data(macs, vd)
 
     def extract_tunnel(nodes):
         macs = set()
         for id, node in nodes.items():
-            try:
-                for mac in node["nodeinfo"]["network"]["mesh"]["bat0"]["interfaces"]["tunnel"]:
-                    macs.add(mac)
-            except KeyError:
-                pass
+            meshes = node.nodeinfo.get("network", {}).get("mesh", {})
+            for mesh in meshes.values():
+                macs.update(mesh.get("interfaces", {}).get("tunnel", []))
 
         return macs
 
-    graph.mark_vpn(batadv_graph, extract_tunnel(nodedb['nodes']))
+    # force mac addresses to be vpn-link only (like gateways for example)
+    vpn_macs = extract_tunnel(nodedb['nodes'])
+    if params['vpn']:
+        vpn_macs.update(params['vpn'])
+
+    batadv_graph.mark_vpn(vpn_macs)
+
+    return batadv_graph
+
+
+def write_node_files(params, publisher, nodedb, now):
+    """
+    Write nodes.json, nodelist.json and with --shards nodes-index.json one
+    node at a time, all of them in one loop over the nodes with
+    --single-pass.
+    """
+    files = [('nodes.json', lambda f: NodesWriter(f, nodedb)),
+             ('nodelist.json', lambda f: NodelistWriter(f, now))]
+    if params['shards']:
+        files.append(('nodes-index.json',
+                      lambda f: IndexWriter(f, now, params['shards'])))
 
-    batadv_graph = graph.merge_nodes(batadv_graph)
-    batadv_graph = graph.to_undirected(batadv_graph)
+    passes = [files] if params['single_pass'] else [[item] for item in files]
+    for group in passes:
+        with ExitStack() as stack:
+            writers = [writer(stack.enter_context(publisher.open(name)))
+                       for name, writer in group]
+            export_nodes(nodedb['nodes'], writers)
 
-    # write processed data to dest dir
-    with open(nodes_fn, 'w') as f:
-        json.dump(nodedb, f)
 
-    graph_out = {'batadv': json_graph.node_link_data(batadv_graph),
+def write_outputs(params, publisher, feed, rrd, nodedb, batadv_graph, now,
+                  tiles=None):
+    # write processed data as a new generation to dest dir
+    publisher.begin()
+
+    write_node_files(params, publisher, nodedb, now)
+
+    graph_out = {'batadv': batadv_graph.node_link_data(),
                  'version': GRAPH_VERSION}
 
-    with open(graph_fn, 'w') as f:
-        json.dump(graph_out, f)
+    with publisher.open('graph.json') as f:
+        dump_graph(graph_out, f)
+
+    if params['ffmap_d3']:
+        with publisher.open('ffmap-d3.json') as f:
+            json.dump(export_ffmap_d3(nodedb, graph_out['batadv']), f)
 
-    with open(nodelist_fn, 'w') as f:
-        json.dump(export_nodelist(now, nodedb), f)
+    delta = feed.update(nodedb['nodes'], graph_out['batadv'], now)
+    feed.publish(publisher, delta)
+
+    if params['shards']:
+        for name, text in export_shards(nodedb, params['shards']):
+            publisher.write(name, text)
+
+    if tiles is not None:
+        tiles.update(nodedb['nodes'])
+        for name, text in tiles.export(nodedb['nodes'], now):
+            publisher.write(name, text)
+
+    # the outputs are up to date with the nodeinfo of every node
+    for node in nodedb['nodes'].values():
+        node.nodeinfo_changed = False
+
+    publisher.commit()
 
     # optional rrd graphs (trigger with --rrd)
-    if params['rrd']:
-        script_directory = os.path.dirname(os.path.realpath(__file__))
-        rrd = RRD(os.path.join(script_directory, 'nodedb'),
-                  os.path.join(params['dest_dir'], 'nodes'))
-        rrd.update_database(nodedb['nodes'])
-        rrd.update_images()
+    if rrd is not None:
+        outdated = rrd.update_database(nodedb['nodes'])
+        if outdated:
+            log.warning('skipped %d node RRDs which need an upgrade, run '
+                        'migrate.py', outdated)
+        written = rrd.update_images()
+        log.info('wrote %d rrd %s files', written, params['rrd_format'])
+
+
+def open_rrd(params):
+    """
+    Return the rrddb.RRD for --with-rrd, None if it is disabled.
+    """
+    if not params['rrd']:
+        return None
+
+    jobs = params['rrd_jobs'] or os.cpu_count() or 1
+    if params['rrdcached']:
+        rrdtool = RRDCached(params['rrdcached'], processes=jobs)
+    else:
+        rrdtool = RRDToolPipe(processes=jobs)
+
+    refresh_intervals = dict()
+    for value in params['rrd_refresh']:
+        timeframe, _, seconds = value.partition('=')
+        refresh_intervals[timeframe] = float(seconds)
+
+    script_directory = os.path.dirname(os.path.realpath(__file__))
+    return RRD(os.path.join(script_directory, 'nodedb'),
+               os.path.join(params['dest_dir'], 'nodes'),
+               rrdtool=rrdtool,
+               jobs=jobs,
+               refresh_intervals=refresh_intervals,
+               image_format=params['rrd_format'],
+               engine=params['rrd_engine'])
+
+
+def open_nodedb(params, nodes_fn):
+    """
+    Return (nodedb, store). Without --node-store, the nodes are read from
+    nodes.json (or its snapshot) and store is None.
+    """
+    if not params['node_store']:
+        return load_nodedb(nodes_fn, nodes_fn + '.snapshot'), None
+
+    store = NodeStore(params['node_store'])
+    if store.created:
+        # start with the nodes of earlier runs
+        nodedb = load_nodedb(nodes_fn)
+        store.save(nodedb['nodes'])
+    else:
+        nodedb = {'nodes': store.load()}
+
+    return nodedb, store
+
+
+def run_daemon(params, publisher, feed, rrd, nodedb, macs,
+               alfred_instances, batman_instances, store=None, tiles=None):
+    """
+    Keep nodedb in memory and run a cycle every params['interval'] seconds.
+
+    SIGHUP reloads the aliases before the next cycle, SIGTERM and SIGINT
+    finish the current cycle, persist the state and exit.
+    """
+    wakeup = threading.Event()
+    signals = {'stop': False, 'reload': False}
+
+    def on_stop(signum, frame):
+        signals['stop'] = True
+        wakeup.set()
+
+    def on_reload(signum, frame):
+        signals['reload'] = True
+
+    signal.signal(signal.SIGTERM, on_stop)
+    signal.signal(signal.SIGINT, on_stop)
+    signal.signal(signal.SIGHUP, on_reload)
+
+    aliases = load_aliases(params['aliases'])
+    log.info('daemon started, interval %ds, %d nodes loaded',
+             params['interval'], len(nodedb['nodes']))
+
+    while not signals['stop']:
+        started = time.monotonic()
+
+        if signals['reload']:
+            signals['reload'] = False
+            try:
+                aliases = load_aliases(params['aliases'])
+                log.info('reloaded aliases')
+            except (IOError, ValueError):
+                log.exception('reloading aliases failed, keeping old ones')
+
+        now = datetime.utcnow().replace(microsecond=0)
+        try:
+            batadv_graph = update(params, nodedb, macs, aliases,
+                                  alfred_instances, batman_instances, now,
+                                  store)
+            write_outputs(params, publisher, feed, rrd, nodedb,
+                          batadv_graph, now, tiles)
+        except Exception:
+            log.exception('cycle failed')
+        else:
+            log.info('cycle finished in %.3fs, %d nodes',
+                     time.monotonic() - started, len(nodedb['nodes']))
+
+        wakeup.wait(max(0, started + params['interval'] - time.monotonic()))
+
+    log.info('daemon stopped')
+
+
+def main(params):
+    os.makedirs(params['dest_dir'], exist_ok=True)
+
+    nodes_fn = os.path.join(params['dest_dir'], 'nodes.json')
+
+    # parse mesh param and instantiate Alfred/Batman instances
+    alfred_instances, batman_instances = parse_mesh(params['mesh'])
+
+    nodedb, store = open_nodedb(params, nodes_fn)
+    macs = nodes.MacIndex(nodedb['nodes'])
+    encodings = ('gzip', 'br') if params['brotli'] else ('gzip',)
+    publisher = Publisher(params['dest_dir'], encodings=encodings)
+    feed = ChangeFeed.load(params['dest_dir'], nodedb['nodes'])
+    rrd = open_rrd(params)
+    tiles = None
+    if params['tiles'] is not None:
+        tiles = TileIndex(params['tiles'])
+
+    try:
+        if params['daemon']:
+            run_daemon(params, publisher, feed, rrd, nodedb, macs,
+                       alfred_instances, batman_instances, store, tiles)
+        else:
+            now = datetime.utcnow().replace(microsecond=0)
+            batadv_graph = update(params, nodedb, macs,
+                                  load_aliases(params['aliases']),
+                                  alfred_instances, batman_instances, now,
+                                  store)
+            write_outputs(params, publisher, feed, rrd, nodedb,
+                          batadv_graph, now, tiles)
+
+        # for the next start, unless the nodes are in the database
+        published = publisher.manifest['files'].get('nodes.json')
+        if store is None and published is not None:
+            save_snapshot(nodes_fn + '.snapshot', nodedb,
+                          published['sha256'])
+    finally:
+        if rrd is not None:
+            rrd.close()
+        if store is not None:
+            store.close()
 
 
 if __name__ == '__main__':
@@ -176,10 +405,77 @@ if __name__ == '__main__':
                         help='Assume MAC addresses are part of vpn')
     parser.add_argument('-p', '--prune', metavar='DAYS', type=int,
                         help='forget nodes offline for at least DAYS')
+    parser.add_argument('--node-store', metavar='FILE',
+                        help='keep the nodes in the SQLite database FILE '
+                             'and only write nodes.json as output (it is '
+                             'read once to fill a new database)')
+    parser.add_argument('--shards', metavar='N', type=int,
+                        help='also write a slim nodes-index.json for the '
+                             'map overview and the full data of the nodes '
+                             'in N files shards/<n>.json')
+    parser.add_argument('--tiles', metavar='MAXZOOM', type=int,
+                        help='also publish the nodes with a location as '
+                             'slippy map tiles tiles/<zoom>/<x>/<y>.json of '
+                             'zoom levels 0 to MAXZOOM')
+    parser.add_argument('--single-pass', action='store_true', default=False,
+                        help='write nodes.json, nodelist.json and '
+                             'nodes-index.json in one loop over the nodes')
+    parser.add_argument('--ffmap-d3', action='store_true', default=False,
+                        help='also write ffmap-d3.json for the old ffmap-d3 '
+                             'front end, like ffmap-d3.jq')
     parser.add_argument('--with-rrd', dest='rrd', action='store_true',
                         default=False,
                         help='enable the rendering of RRD graphs (cpu '
                              'intensive)')
+    parser.add_argument('--rrdcached', metavar='ADDRESS',
+                        help='send RRD updates to the rrdcached listening on '
+                             'the unix socket ADDRESS')
+    parser.add_argument('--rrd-jobs', metavar='N', type=int,
+                        help='render at most N RRD graphs at once (defaults '
+                             'to the number of CPUs)')
+    parser.add_argument('--rrd-format', choices=('png', 'json'),
+                        default='png',
+                        help='render RRD graphs as png (default) or export '
+                             'their series as json for the frontend to draw')
+    parser.add_argument('--rrd-engine', choices=('rrdtool', 'array'),
+                        default='rrdtool',
+                        help='store RRD data with rrdtool (default) or in '
+                             'memory-mapped files without any subprocesses '
+                             '(requires --rrd-format json)')
+    parser.add_argument('--rrd-refresh', nargs='+', default=[],
+                        metavar='TIMEFRAME=SECONDS',
+                        help='render graphs over TIMEFRAME (like 1d) at most '
+                             'every SECONDS seconds (defaults to the time '
+                             'one pixel of the graph covers)')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        help='run at most N data collection commands at '
+                             'once (defaults to all of them)')
+    parser.add_argument('--with-brotli', dest='brotli', action='store_true',
+                        default=False,
+                        help='publish brotli compressed copies of all files '
+                             'next to the gzip compressed ones (requires the '
+                             'brotli module)')
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='keep running and update every --interval '
+                             'seconds instead of exiting after one run')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False,
+                        help='log what each run does (always on in daemon '
+                             'mode)')
+    parser.add_argument('--interval', metavar='SECONDS', type=int,
+                        default=60,
+                        help='seconds between runs in daemon mode '
+                             '(defaults to 60)')
 
     options = vars(parser.parse_args())
+    if options['shards'] is not None and options['shards'] < 1:
+        parser.error('--shards must be at least 1')
+    if options['tiles'] is not None and not 0 <= options['tiles'] <= 20:
+        parser.error('--tiles must be between 0 and 20')
+    if options['rrd_engine'] == 'array' and options['rrd_format'] != 'json':
+        parser.error('--rrd-engine array requires --rrd-format json')
+    logging.basicConfig(
+        level=logging.INFO if options['daemon'] or options['verbose']
+        else logging.WARNING,
+        format='%(asctime)s %(levelname)s %(message)s')
     main(options)
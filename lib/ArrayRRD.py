@@ -0,0 +1,435 @@
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+from lib.GlobalRRD import GlobalRRD
+from lib.NodeRRD import NodeRRD
+from lib.RRD import DS, RRA, RRD, RRDIncompatibleException
+
+MAGIC = b'ffmaprrd'
+VERSION = 1
+
+# magic, version, step, number of RRAs, number of DS, last update
+HEADER = struct.Struct('<8sIIIId')
+# cf, xff, PDPs per row, rows, index of the last row written
+RRA_DEF = struct.Struct('<8sdIII')
+# name, type, heartbeat, min, max
+DS_DEF = struct.Struct('<20s20sIdd')
+# PDP: value and unknown seconds so far, CDP: value and unknown PDPs so far
+PREP = struct.Struct('<dd')
+
+# DS slots reserved in a file, so DS can be added in place
+DS_CAPACITY = 16
+
+NAN = float('NaN')
+
+
+def _nan(value):
+    return NAN if value == 'U' else float(value)
+
+
+def _accumulate(prep, pdp, count):
+    value, unknown = prep
+    if math.isnan(pdp):
+        return value, unknown + count
+    return value + pdp * count, unknown
+
+
+class _Layout(object):
+    """
+    Where things are in an ArrayRRD file.
+
+    The header is followed by the RRA definitions, DS_CAPACITY DS
+    definitions and a block per DS. A block holds the PDP preparation of the
+    DS, then for every RRA its CDP preparation and rows.
+    """
+    def __init__(self, buf):
+        magic, version, self.step, rra_count, ds_count, self.last_update = \
+            HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RRDIncompatibleException('not an ArrayRRD file')
+
+        self.rras = [RRA_DEF.unpack_from(buf, self.rra_def(j))
+                     for j in range(rra_count)]
+        self.dss = [DS_DEF.unpack_from(buf, self.ds_def(i))
+                    for i in range(ds_count)]
+
+        self._rra_offsets = []
+        offset = PREP.size
+        for rra in self.rras:
+            self._rra_offsets.append(offset)
+            offset += PREP.size + 8 * rra[3]
+        self.block_size = offset
+
+    @staticmethod
+    def size(rra_count, rows):
+        """
+        Return the offset of the first DS block and the size of a block.
+        """
+        blocks = sum([HEADER.size, rra_count * RRA_DEF.size,
+                      DS_CAPACITY * DS_DEF.size])
+        return blocks, PREP.size + sum(PREP.size + 8 * n for n in rows)
+
+    def rra_def(self, j):
+        return HEADER.size + j * RRA_DEF.size
+
+    def ds_def(self, i):
+        return HEADER.size + len(self.rras) * RRA_DEF.size + i * DS_DEF.size
+
+    def block(self, i):
+        return self.ds_def(DS_CAPACITY) + i * self.block_size
+
+    def pdp_prep(self, i):
+        return self.block(i)
+
+    def cdp_prep(self, i, j):
+        return self.block(i) + self._rra_offsets[j]
+
+    def rows(self, i, j):
+        return self.cdp_prep(i, j) + PREP.size
+
+
+def _decode(name):
+    return name.rstrip(b'\0').decode('ascii')
+
+
+class ArrayRRD(RRD):
+    """
+    An RRD stored in a memory-mapped file instead of by rrdtool.
+
+    It supports GAUGE DS and AVERAGE RRAs with the semantics of rrdtool:
+    values are known for at most heartbeat seconds and within min and max,
+    a PDP is unknown if more than heartbeat of its seconds are, and a row
+    is unknown if more than xff of its PDPs are. Updates are written into
+    the file in place, no process is started. DS are added by appending a
+    block to the file, no dump and restore needed.
+
+    Graphs can't be rendered, use fetch() to export the series instead.
+    """
+    extension = 'arrd'
+
+    @contextmanager
+    def _mapped(self):
+        with open(self.filename, 'r+b') as f:
+            buf = mmap.mmap(f.fileno(), 0)
+            try:
+                yield buf, _Layout(buf)
+            finally:
+                buf.close()
+
+    def create(self, ds_list, rra_list, step=300, start=None):
+        """
+        Create a new file with ds_list and rra_list, the first update must
+        be later than start (defaults to 10 seconds ago).
+        """
+        if len(ds_list) > DS_CAPACITY:
+            raise ValueError('ArrayRRD: at most {0} DS'.format(DS_CAPACITY))
+        for ds in ds_list:
+            if ds.type != 'GAUGE':
+                raise ValueError('ArrayRRD: {0} is {1}, only GAUGE is '
+                                 'supported'.format(ds.name, ds.type))
+        for rra in rra_list:
+            if rra.cf != 'AVERAGE':
+                raise ValueError('ArrayRRD: only AVERAGE RRAs are supported')
+
+        if start is None:
+            start = time.time() - 10
+        blocks, block_size = _Layout.size(len(rra_list),
+                                          [rra.args[2] for rra in rra_list])
+
+        buf = bytearray(blocks + len(ds_list) * block_size)
+        HEADER.pack_into(buf, 0, MAGIC, VERSION, step, len(rra_list),
+                         len(ds_list), start)
+        for j, rra in enumerate(rra_list):
+            xff, pdp_per_row, rows = rra.args
+            RRA_DEF.pack_into(buf, HEADER.size + j * RRA_DEF.size,
+                              rra.cf.encode('ascii'), xff, pdp_per_row, rows,
+                              0)
+
+        layout = _Layout(buf)
+        for i, ds in enumerate(ds_list):
+            self._write_ds(buf, layout, i, ds)
+
+        with open(self.filename + '.new', 'wb') as f:
+            f.write(buf)
+        os.rename(self.filename + '.new', self.filename)
+
+        self._cached_info = None
+        self._ds_names = [ds.name for ds in ds_list]
+
+    @staticmethod
+    def _write_ds(buf, layout, i, ds):
+        """
+        Write the definition of DS i and reset its block, as if it had
+        been unknown so far.
+        """
+        heartbeat, ds_min, ds_max = ds.args
+        DS_DEF.pack_into(buf, layout.ds_def(i), ds.name.encode('ascii'),
+                         ds.type.encode('ascii'), heartbeat, _nan(ds_min),
+                         _nan(ds_max))
+
+        step = layout.step
+        pdp_start = layout.last_update // step * step
+        PREP.pack_into(buf, layout.pdp_prep(i), 0.0,
+                       layout.last_update - pdp_start)
+        for j, (_, _, pdp_per_row, rows, _) in enumerate(layout.rras):
+            row_start = pdp_start // (step * pdp_per_row) * step * pdp_per_row
+            PREP.pack_into(buf, layout.cdp_prep(i, j), 0.0,
+                           (pdp_start - row_start) // step)
+            struct.pack_into('<{0}d'.format(rows), buf, layout.rows(i, j),
+                             *[NAN] * rows)
+
+    def info(self):
+        """
+        Return a dictionary like RRD.info() with the step, last_update, the
+        DS and the RRAs.
+        """
+        if self._cached_info:
+            return self._cached_info
+
+        with self._mapped() as (buf, layout):
+            dss = dict()
+            for i, (name, dst, heartbeat, ds_min, ds_max) in \
+                    enumerate(layout.dss):
+                ds = DS(_decode(name), _decode(dst), heartbeat, ds_min,
+                        ds_max)
+                ds.index = i
+                dss[ds.name] = ds
+            rras = [RRA(_decode(cf), xff, pdp_per_row, rows)
+                    for cf, xff, pdp_per_row, rows, _ in layout.rras]
+
+            self._cached_info = {'filename': self.filename,
+                                 'step': layout.step,
+                                 'last_update': layout.last_update,
+                                 'ds': dss,
+                                 'rra': rras}
+        return self._cached_info
+
+    def upgrade(self, dss):
+        """
+        Add the DS in dss missing in the file, update the definition of
+        those already in it. DS can't change their type.
+        """
+        with self._mapped() as (buf, layout):
+            names = [_decode(ds[0]) for ds in layout.dss]
+            size = layout.block(len(names))
+
+        added = [ds for ds in dss if ds.name not in names]
+        if len(names) + len(added) > DS_CAPACITY:
+            raise RRDIncompatibleException(
+                'ArrayRRD: at most {0} DS'.format(DS_CAPACITY))
+
+        if added:
+            with open(self.filename, 'r+b') as f:
+                f.truncate(size + len(added) * layout.block_size)
+
+        with self._mapped() as (buf, layout):
+            for ds in dss:
+                if ds.name not in names:
+                    continue
+                i = names.index(ds.name)
+                if _decode(layout.dss[i][1]) != ds.type:
+                    raise RuntimeError(
+                        "Cannot convert existing DS '{}'"
+                        "from type '{}' to '{}'".format(
+                            ds.name, _decode(layout.dss[i][1]), ds.type))
+                heartbeat, ds_min, ds_max = ds.args
+                DS_DEF.pack_into(buf, layout.ds_def(i), *(
+                    layout.dss[i][:2] + (heartbeat, _nan(ds_min),
+                                         _nan(ds_max))))
+
+            for i, ds in enumerate(added, len(names)):
+                self._write_ds(buf, layout, i, ds)
+
+            # the new DS only count once they are complete
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, layout.step,
+                             len(layout.rras), len(names) + len(added),
+                             layout.last_update)
+
+        self._cached_info = None
+        self._ds_names = None
+
+    def update(self, V):
+        """
+        Update the RRD with new values V as of now, see RRD.update().
+        """
+        now = time.time()
+        with self._mapped() as (buf, layout):
+            names = [_decode(ds[0]) for ds in layout.dss]
+            if hasattr(V, 'keys'):
+                V = [V.get(name, 'U') for name in names]
+            if len(V) != len(names):
+                raise ValueError('ArrayRRD: expected {0} values, got {1}'.
+                                 format(len(names), len(V)))
+            if now <= layout.last_update:
+                raise ValueError('ArrayRRD: illegal attempt to update using '
+                                 'time {0} when last update time is {1}'.
+                                 format(now, layout.last_update))
+
+            pdps = [self._update_pdp(buf, layout, i, _nan(value), now)
+                    for i, value in enumerate(V)]
+            self._update_rras(buf, layout, pdps, now)
+
+            HEADER.pack_into(buf, 0, MAGIC, VERSION, layout.step,
+                             len(layout.rras), len(layout.dss), now)
+
+        self._cached_info = None
+
+    @staticmethod
+    def _update_pdp(buf, layout, i, value, now):
+        """
+        Add value from the last update until now to the PDP of DS i.
+        Returns the value of the PDPs completed by the update.
+        """
+        _, _, heartbeat, ds_min, ds_max = layout.dss[i]
+        step = layout.step
+        last_update = layout.last_update
+        interval = now - last_update
+        known = not math.isnan(value) and interval <= heartbeat and \
+            not value < ds_min and not value > ds_max
+
+        pdp_start = last_update // step * step
+        boundary = now // step * step
+        offset = layout.pdp_prep(i)
+        pdp_value, unknown = PREP.unpack_from(buf, offset)
+
+        if boundary == pdp_start:
+            if known:
+                pdp_value += value * interval
+            else:
+                unknown += interval
+            PREP.pack_into(buf, offset, pdp_value, unknown)
+            return NAN
+
+        # like rrdtool, all PDPs completed get the same value
+        before = boundary - last_update
+        if known:
+            pdp_value += value * before
+        else:
+            unknown += before
+        known_seconds = boundary - pdp_start - unknown
+        if unknown > heartbeat or known_seconds <= 0:
+            pdp = NAN
+        else:
+            pdp = pdp_value / known_seconds
+
+        after = now - boundary
+        if known:
+            PREP.pack_into(buf, offset, value * after, 0.0)
+        else:
+            PREP.pack_into(buf, offset, 0.0, after)
+
+        return pdp
+
+    @staticmethod
+    def _update_rras(buf, layout, pdps, now):
+        """
+        Consolidate the PDPs completed by an update into the RRAs.
+        """
+        step = layout.step
+        pdp_start = layout.last_update // step * step
+        boundary = now // step * step
+        if boundary == pdp_start:
+            return
+
+        for j, (cf, xff, pdp_per_row, rows, cur_row) in \
+                enumerate(layout.rras):
+            resolution = step * pdp_per_row
+            row_end = (pdp_start // resolution + 1) * resolution
+            last_row_end = boundary // resolution * resolution
+
+            for i, pdp in enumerate(pdps):
+                offset = layout.cdp_prep(i, j)
+                prep = PREP.unpack_from(buf, offset)
+
+                if boundary < row_end:
+                    prep = _accumulate(prep, pdp,
+                                       (boundary - pdp_start) // step)
+                    PREP.pack_into(buf, offset, *prep)
+                    continue
+
+                value, unknown = _accumulate(prep, pdp,
+                                             (row_end - pdp_start) // step)
+                if unknown > xff * pdp_per_row or unknown >= pdp_per_row:
+                    values = [NAN]
+                else:
+                    values = [value / (pdp_per_row - unknown)]
+
+                # rows without any update in between
+                full = int(last_row_end - row_end) // resolution
+                values.extend([pdp] * min(full, rows))
+                values = values[-rows:]
+
+                first = (cur_row + 1 + full + 1 - len(values)) % rows
+                head = values[:rows - first]
+                tail = values[rows - first:]
+                struct.pack_into('<{0}d'.format(len(head)), buf,
+                                 layout.rows(i, j) + 8 * first, *head)
+                if tail:
+                    struct.pack_into('<{0}d'.format(len(tail)), buf,
+                                     layout.rows(i, j), *tail)
+
+                PREP.pack_into(buf, offset, *_accumulate(
+                    (0.0, 0.0), pdp, (boundary - last_row_end) // step))
+
+            if boundary >= row_end:
+                full = int(last_row_end - row_end) // resolution
+                RRA_DEF.pack_into(buf, layout.rra_def(j), cf, xff,
+                                  pdp_per_row, rows,
+                                  (cur_row + 1 + full) % rows)
+
+    def fetch(self, cf, resolution, start, end):
+        """
+        Like RRD.fetch(), picks the RRA with cf closest to resolution among
+        those reaching back to start, or the one reaching back furthest.
+        """
+        with self._mapped() as (buf, layout):
+            candidates = []
+            for j, (rra_cf, _, pdp_per_row, rows, cur_row) in \
+                    enumerate(layout.rras):
+                if _decode(rra_cf) != cf:
+                    continue
+                step = layout.step * pdp_per_row
+                last_row = int(layout.last_update // step * step)
+                covers = last_row - rows * step <= start
+                candidates.append((not covers,
+                                   abs(step - resolution) if covers
+                                   else -rows * step,
+                                   j, step, last_row, rows, cur_row))
+            if not candidates:
+                raise ValueError('ArrayRRD: no {0} RRA'.format(cf))
+
+            _, _, j, step, last_row, rows, cur_row = min(candidates)
+            columns = [struct.unpack_from('<{0}d'.format(rows), buf,
+                                          layout.rows(i, j))
+                       for i in range(len(layout.dss))]
+            names = [_decode(ds[0]) for ds in layout.dss]
+
+        result = []
+        for timestamp in range(int(start) // step * step + step,
+                               int(end) // step * step + 2 * step, step):
+            age = (last_row - timestamp) // step
+            if 0 <= age < rows:
+                row = (cur_row - age) % rows
+                values = [None if math.isnan(column[row]) else column[row]
+                          for column in columns]
+            else:
+                values = [None] * len(columns)
+            result.append((timestamp, values))
+
+        return names, result
+
+    def graph(self, *args):
+        raise RuntimeError('ArrayRRD: graphs need rrdtool, export the '
+                           'series instead')
+
+
+class ArrayNodeRRD(NodeRRD, ArrayRRD):
+    graph = ArrayRRD.graph
+
+
+class ArrayGlobalRRD(GlobalRRD, ArrayRRD):
+    graph = ArrayRRD.graph
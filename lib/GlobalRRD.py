@@ -1,10 +1,10 @@
 import os
-import subprocess
 
 from lib.RRD import DS, RRA, RRD
 
 
 class GlobalRRD(RRD):
+    step = 60
     ds_list = [
         # Number of nodes available
         DS('nodes', 'GAUGE', 120, 0, float('NaN')),
@@ -20,16 +20,17 @@ class GlobalRRD(RRD):
         RRA('AVERAGE', 0.5, 1440, 1780),
     ]
 
-    def __init__(self, directory):
-        super().__init__(os.path.join(directory, "nodes.rrd"))
-        self.ensure_sanity(self.ds_list, self.rra_list, step=60)
+    def __init__(self, directory, rrdtool=None, schema_cache=None):
+        super().__init__(os.path.join(directory, "nodes." + self.extension),
+                         rrdtool, schema_cache)
+        self.ensure_sanity(self.ds_list, self.rra_list, step=self.step)
 
     # TODO: fix this, python does not support function overloading
     def update(self, node_count, client_count):
         super().update({'nodes': node_count, 'clients': client_count})
 
     def graph(self, filename, timeframe):
-        args = ["rrdtool", 'graph', filename,
+        args = [filename,
                 '-s', '-' + timeframe,
                 '-w', '800',
                 '-h' '400',
@@ -37,4 +38,4 @@ class GlobalRRD(RRD):
                 'LINE1:nodes#F00:nodes\\l',
                 'DEF:clients=' + self.filename + ':clients:AVERAGE',
                 'LINE2:clients#00F:clients']
-        subprocess.check_output(args)
+        self.rrdtool.run('graph', *args)
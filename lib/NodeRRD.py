@@ -1,10 +1,10 @@
 import os
-import subprocess
 
 from lib.RRD import DS, RRA, RRD
 
 
 class NodeRRD(RRD):
+    step = 60
     ds_list = [
         DS('upstate', 'GAUGE', 120, 0, 1),
         DS('clients', 'GAUGE', 120, 0, float('NaN')),
@@ -20,32 +20,39 @@ class NodeRRD(RRD):
         RRA('AVERAGE', 0.5, 720, 730),
     ]
 
-    def __init__(self, filename, node=None):
+    def __init__(self, filename, node=None, rrdtool=None, schema_cache=None,
+                 upgrade=True):
         """
         Create a new RRD for a given node.
 
         If the RRD isn't supposed to be updated, the node can be omitted.
+        If upgrade is False, an outdated RRD raises RRDOutdatedException.
         """
         self.node = node
-        super().__init__(filename)
-        self.ensure_sanity(self.ds_list, self.rra_list, step=60)
+        super().__init__(filename, rrdtool, schema_cache)
+        self.ensure_sanity(self.ds_list, self.rra_list, upgrade=upgrade,
+                           step=self.step)
+
+    @staticmethod
+    def image_name(filename):
+        return "{basename}.png".format(
+            basename=os.path.basename(filename).rsplit('.', 2)[0])
 
     @property
     def imagename(self):
-        return "{basename}.png".format(
-            basename=os.path.basename(self.filename).rsplit('.', 2)[0])
+        return self.image_name(self.filename)
 
     # TODO: fix this, python does not support function overloading
     def update(self):
-        super().update({'upstate': int(self.node['flags']['online']),
-                        'clients': self.node['statistics']['clients']})
+        super().update({'upstate': int(self.node.online),
+                        'clients': self.node.statistics['clients']})
 
     def graph(self, directory, timeframe):
         """
         Create a graph in the given directory. The file will be named
         basename.png if the RRD file is named basename.rrd
         """
-        args = ['rrdtool', 'graph', os.path.join(directory, self.imagename),
+        args = [os.path.join(directory, self.imagename),
                 '-s', '-' + timeframe,
                 '-w', '800',
                 '-h', '400',
@@ -58,4 +65,4 @@ class NodeRRD(RRD):
                 'AREA:c#0F0:up\\l',
                 'AREA:d#F00:down\\l',
                 'LINE1:c#00F:clients connected\\l']
-        subprocess.check_output(args)
+        self.rrdtool.run('graph', *args)
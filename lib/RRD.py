@@ -6,6 +6,8 @@ from functools import reduce
 from itertools import starmap
 import math
 
+from lib.rrdtool import RRDTool
+
 
 class RRDIncompatibleException(Exception):
     """
@@ -48,31 +50,56 @@ class RRD(object):
             "? (?P<value>.*?) "?
         $""", re.X)
     _cached_info = None
+    _ds_names = None
+    # of the files
+    extension = 'rrd'
 
     def _exec_rrdtool(self, cmd, *args, **kwargs):
-        pargs = ["rrdtool", cmd, self.filename]
+        pargs = [self.filename]
         for k, v in kwargs.items():
             pargs.extend(["--" + k, str(v)])
         pargs.extend(args)
-        subprocess.check_output(pargs)
+        return self.rrdtool.run(cmd, *pargs)
 
-    def __init__(self, filename):
+    def __init__(self, filename, rrdtool=None, schema_cache=None):
+        """
+        rrdtool is the lib.rrdtool backend running the commands, by default
+        every command is run as a process of its own. If a
+        lib.schemacache.SchemaCache is given, ensure_sanity() skips files it
+        has verified before.
+        """
         self.filename = filename
+        self.rrdtool = rrdtool or RRDTool()
+        self.schema_cache = schema_cache
 
-    def ensure_sanity(self, ds_list, rra_list, **kwargs):
+    def ensure_sanity(self, ds_list, rra_list, upgrade=True, **kwargs):
         """
         Create or upgrade the RRD file if necessary to contain all DS in
         ds_list. If it needs to be created, the RRAs in rra_list and any kwargs
         will be used for creation. Note that RRAs and options of an existing
         database are NOT modified!
+
+        If upgrade is False, an RRD which needs an upgrade raises
+        RRDOutdatedException instead, see migrate.py.
         """
+        if self.schema_cache is not None:
+            ds_names = self.schema_cache.get(self.filename, ds_list)
+            if ds_names is not None:
+                self._ds_names = ds_names
+                return
+
         try:
             self.check_sanity(ds_list)
         except FileNotFoundError:
             self.create(ds_list, rra_list, **kwargs)
         except RRDOutdatedException:
+            if not upgrade:
+                raise
             self.upgrade(ds_list)
 
+        if self.schema_cache is not None:
+            self.schema_cache.add(self.filename, ds_list, self.ds_names())
+
     def check_sanity(self, ds_list=()):
         """
         Check if the RRD file exists and contains (at least) the DS listed in
@@ -121,6 +148,9 @@ class RRD(object):
                 new_ds.append(ds)
         added_ds_num = len(new_ds) - len(info['ds'])
 
+        # rrdcached may still hold updates for the old definition
+        self.rrdtool.flush(self.filename)
+
         dump = subprocess.Popen(
             ["rrdtool", "dump", self.filename],
             stdout=subprocess.PIPE)
@@ -186,6 +216,7 @@ class RRD(object):
 
         os.rename(self.filename + ".new", self.filename)
         self._cached_info = None
+        self._ds_names = None
 
     def create(self, ds_list, rra_list, **kwargs):
         """
@@ -199,6 +230,7 @@ class RRD(object):
             **kwargs
         )
         self._cached_info = None
+        self._ds_names = [ds.name for ds in ds_list]
 
     def update(self, V):
         """
@@ -210,16 +242,57 @@ class RRD(object):
           passing a "template" to rrdtool update (see man rrdupdate).
         * If it is a list, no template is generated and the order of the
           values in V must be the same as that of the DS in the RRD.
+
+        If the backend doesn't support templates, a dict is turned into a
+        list in the order of the DS in the RRD, missing DS are unknown.
         """
+        if hasattr(V, 'keys') and not self.rrdtool.supports_template:
+            V = [V.get(name, 'U') for name in self.ds_names()]
+
         try:
             args = ['N:' + ':'.join(map(str, V.values()))]
             kwargs = {'template': ':'.join(V.keys())}
         except AttributeError:
             args = ['N:' + ':'.join(map(str, V))]
             kwargs = {}
-        self._exec_rrdtool("update", *args, **kwargs)
+        self.rrdtool.update(self.filename, args[0], kwargs.get('template'))
         self._cached_info = None
 
+    def ds_names(self):
+        """
+        Return the names of the DS in the RRD in their order.
+        """
+        if self._ds_names is None:
+            dss = sorted(self.info()['ds'].values(), key=lambda ds: ds.index)
+            self._ds_names = [ds.name for ds in dss]
+        return self._ds_names
+
+    def fetch(self, cf, resolution, start, end):
+        """
+        Fetch the consolidated values of the RRA with cf closest to
+        resolution seconds per row from start to end (unix timestamps).
+
+        Returns (ds_names, rows), rows being (timestamp, values) tuples with
+        None for unknown values. See `man rrdfetch` for more details.
+        """
+        out = self._exec_rrdtool("fetch", cf,
+                                 "-r", int(resolution),
+                                 "-s", int(start),
+                                 "-e", int(end))
+        lines = out.splitlines()
+        ds_names = lines[0].split()
+        rows = []
+        for line in lines[1:]:
+            timestamp, sep, values = line.partition(':')
+            if not sep:
+                continue
+            values = [float(value) for value in values.split()]
+            rows.append((int(timestamp),
+                         [None if math.isnan(value) else value
+                          for value in values]))
+
+        return ds_names, rows
+
     def info(self):
         """
         Return a dictionary with information about the RRD.
@@ -228,15 +301,7 @@ class RRD(object):
         """
         if self._cached_info:
             return self._cached_info
-        env = os.environ.copy()
-        env["LC_ALL"] = "C"
-        proc = subprocess.Popen(
-            ["rrdtool", "info", self.filename],
-            stdout=subprocess.PIPE,
-            env=env
-        )
-        out, err = proc.communicate()
-        out = out.decode()
+        out = self._exec_rrdtool("info")
         info = {}
         for line in out.splitlines():
             base = info
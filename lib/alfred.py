@@ -1,27 +1,105 @@
-import subprocess
 import json
 import os
+import random
+import socket
+import struct
+import zlib
+
+ALFRED_SOCK_PATH_DEFAULT = '/var/run/alfred.sock'
+ALFRED_VERSION = 0
+
+# alfred packet types, see packet.h of alfred
+ALFRED_PUSH_DATA = 0
+ALFRED_REQUEST = 2
+ALFRED_STATUS_ERROR = 4
+
+# type, version, length (of the payload following the header)
+TLV = struct.Struct('!BBH')
+# tlv, requested type, transaction id
+REQUEST = struct.Struct('!BBHBH')
+# transaction id, sequence number (error code for status packets)
+TRANSACTION = struct.Struct('!HH')
+# source mac, tlv of the data
+DATA = struct.Struct('!6sBBH')
 
 
 class Alfred(object):
     """
-    Bindings for the alfred-json utility
+    Client for the alfred unix socket
     """
     def __init__(self, unix_sockpath=None):
         self.unix_sock = unix_sockpath
         if unix_sockpath is not None and not os.path.exists(unix_sockpath):
             raise RuntimeError('alfred: invalid unix socket path given')
 
+    @staticmethod
+    def _packets(stream):
+        """
+        Yield (type, payload) of every packet until alfred closes the
+        connection.
+        """
+        header = stream.read(TLV.size)
+        while header:
+            if len(header) != TLV.size:
+                raise RuntimeError('alfred: truncated packet')
+            packet_type, _, length = TLV.unpack(header)
+            payload = stream.read(length)
+            if len(payload) != length:
+                raise RuntimeError('alfred: truncated packet')
+
+            yield packet_type, payload
+            header = stream.read(TLV.size)
+
+    @staticmethod
+    def _records(payload):
+        """
+        Yield the data of every record in a push data packet.
+        """
+        offset = TRANSACTION.size
+        while offset < len(payload):
+            _, _, _, size = DATA.unpack_from(payload, offset)
+            offset += DATA.size
+            yield payload[offset:offset + size]
+            offset += size
+
+    @staticmethod
+    def _decode(data):
+        # payloads are usually gzip or zlib compressed, but need not be
+        try:
+            data = zlib.decompress(data, 32 + zlib.MAX_WBITS)
+        except zlib.error:
+            pass
+        return json.loads(data.decode('utf-8'))
+
     def _fetch(self, data_type):
-        cmd = ['alfred-json',
-               '-z',
-               '-f', 'json',
-               '-r', str(data_type)]
-        if self.unix_sock:
-            cmd.extend(['-s', self.unix_sock])
-
-        output = subprocess.check_output(cmd)
-        return json.loads(output.decode("utf-8")).values()
+        """
+        Request all records of data_type and yield them as they arrive.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.unix_sock or ALFRED_SOCK_PATH_DEFAULT)
+            sock.sendall(REQUEST.pack(ALFRED_REQUEST, ALFRED_VERSION,
+                                      REQUEST.size - TLV.size, data_type,
+                                      random.getrandbits(16)))
+
+            with sock.makefile('rb') as stream:
+                for packet_type, payload in self._packets(stream):
+                    if packet_type == ALFRED_STATUS_ERROR:
+                        _, code = TRANSACTION.unpack_from(payload)
+                        raise RuntimeError(
+                            'alfred: request for data type {0} failed with '
+                            'error {1}'.format(data_type, code))
+
+                    if packet_type != ALFRED_PUSH_DATA:
+                        continue
+
+                    for data in self._records(payload):
+                        try:
+                            yield self._decode(data)
+                        except (UnicodeDecodeError, ValueError):
+                            pass
+        finally:
+            sock.close()
 
     def nodeinfo(self):
         return self._fetch(158)
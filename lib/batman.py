@@ -29,44 +29,60 @@ class Batman(object):
 
     @staticmethod
     def vis_data_helper(lines):
-        vd_tmp = []
         for line in lines:
             try:
                 utf8_line = line.decode('utf-8')
-                vd_tmp.append(json.loads(utf8_line))
             except UnicodeDecodeError:
-                pass
-        return vd_tmp
+                continue
+            yield json.loads(utf8_line)
 
     def vis_data_batadv_vis(self):
         """
         Parse "batadv-vis -i <mesh_interface> -f json"
-        into an array of dictionaries.
+        yielding a dictionary per line while it is read from the pipe.
         """
         cmd = ['batadv-vis', '-i', self.mesh_interface, '-f', 'json']
         if self.alfred_sock:
             cmd.extend(['-u', self.alfred_sock])
-        output = subprocess.check_output(cmd, env=self.environ)
-        lines = output.splitlines()
-        return self.vis_data_helper(lines)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=self.environ)
+        with proc.stdout:
+            yield from self.vis_data_helper(proc.stdout)
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    def _batctl(self, *args):
+        """
+        Start "batctl -m <mesh_interface> <args>" without waiting for it.
+        """
+        cmd = ['batctl', '-m', self.mesh_interface]
+        cmd.extend(args)
+        if os.geteuid() > 0:
+            cmd.insert(0, 'sudo')
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE, env=self.environ)
+
+    @staticmethod
+    def _output(proc):
+        output, _ = proc.communicate()
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args,
+                                                output)
+        return output.decode('utf-8')
 
     def gateway_list(self):
         """
         Parse "batctl -m <mesh_interface> gwl -n"
         into an array of dictionaries.
         """
-        cmd = ['batctl', '-m', self.mesh_interface, 'gwl', '-n']
-        if os.geteuid() > 0:
-            cmd.insert(0, 'sudo')
-        output = subprocess.check_output(cmd, env=self.environ)
-        output_utf8 = output.decode('utf-8')
-        rows = output_utf8.splitlines()
+        # start both batctl calls at once, gwl output depends on the gw mode
+        gwl = self._batctl('gwl', '-n')
+        gw = self._batctl('gw')
+        rows = self._output(gwl).splitlines()
+        mode, bandwidth = self._parse_gateway_mode(self._output(gw))
 
         gateways = []
 
         # local gateway
         header = rows.pop(0)
-        mode, bandwidth = self.gateway_mode()
         if mode == 'server':
             local_gw_mac = self.mac_addr_pattern.search(header).group(0)
             gateways.append(local_gw_mac)
@@ -84,11 +100,11 @@ class Batman(object):
         Parse "batctl -m <mesh_interface> gw"
         return: tuple mode, bandwidth, if mode != server then bandwidth is None
         """
-        cmd = ['batctl', '-m', self.mesh_interface, 'gw']
-        if os.geteuid() > 0:
-            cmd.insert(0, 'sudo')
-        output = subprocess.check_output(cmd, env=self.environ)
-        chunks = output.decode("utf-8").split()
+        return self._parse_gateway_mode(self._output(self._batctl('gw')))
+
+    @staticmethod
+    def _parse_gateway_mode(output):
+        chunks = output.split()
 
         return chunks[0], chunks[3] if 3 in chunks else None
 
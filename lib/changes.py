@@ -0,0 +1,200 @@
+import json
+import os
+
+CHANGES_VERSION = 1
+
+# statistics in the deltas, the others change with almost every run
+DELTA_STATISTICS = ('clients', 'gateway')
+
+
+def _delta_statistics(statistics):
+    return dict((key, statistics[key]) for key in DELTA_STATISTICS
+                if key in statistics)
+
+
+def _snapshot_nodes(nodes):
+    return dict((node_id, (node.flags, node.nodeinfo,
+                           _delta_statistics(node.statistics)))
+                for node_id, node in nodes.items())
+
+
+def _snapshot_links(graph_data):
+    ids = [node['id'] for node in graph_data['nodes']]
+    links = dict()
+    for link in graph_data['links']:
+        a, b = sorted([ids[link['source']], ids[link['target']]])
+        link = dict(link, source=a, target=b)
+        links[(a, b)] = link
+
+    return links
+
+
+def _merge_patch(old, new):
+    """
+    Return a JSON merge patch (RFC 7396) of the top level keys of new that
+    differ from old, keys missing in new are set to None.
+    """
+    patch = dict((key, value) for key, value in new.items()
+                 if old.get(key) != value)
+    patch.update((key, None) for key in old if key not in new)
+
+    return patch
+
+
+def diff_nodes(old, nodes):
+    added = dict()
+    changed = dict()
+    online = []
+    offline = []
+
+    for node_id, node in nodes.items():
+        if node_id not in old:
+            added[node_id] = node.export()
+            continue
+
+        flags, nodeinfo, statistics = old[node_id]
+        if node.online != flags.get('online'):
+            if node.online:
+                online.append(node_id)
+            else:
+                offline.append(node_id)
+
+        fields = [('flags', flags, node.flags),
+                  ('statistics', statistics,
+                   _delta_statistics(node.statistics))]
+        # nodeinfo is only compared if it changed since the last run
+        if node.nodeinfo_changed:
+            fields.append(('nodeinfo', nodeinfo, node.nodeinfo))
+
+        patch = dict()
+        for name, previous, current in fields:
+            field_patch = _merge_patch(previous, current)
+            if field_patch:
+                patch[name] = field_patch
+        if patch:
+            changed[node_id] = patch
+
+    return {'added': added,
+            'removed': [node_id for node_id in old if node_id not in nodes],
+            'online': online,
+            'offline': offline,
+            'changed': changed}
+
+
+def diff_links(old, links):
+    return {'added': [link for key, link in links.items() if key not in old],
+            'removed': [list(key) for key in old if key not in links],
+            'changed': [link for key, link in links.items()
+                        if key in old and old[key] != link]}
+
+
+def _delta_name(sequence):
+    return 'changes/{0}.json'.format(sequence)
+
+
+class ChangeFeed(object):
+    """
+    Computes what changed between consecutive runs.
+
+    Every run gets a delta with an increasing sequence number, listing nodes
+    added and removed, nodes that went online or offline, JSON merge patches
+    of changed flags, nodeinfo and the statistics in DELTA_STATISTICS, and
+    links added, removed or changed.
+
+    Each delta is published once as changes/<sequence>.json and then kept
+    unchanged by the publisher, as long as it is among the last `history`
+    deltas and these stay below history_bytes. changes/index.json lists
+    them, so clients that missed a few runs can catch up without
+    downloading the full snapshots.
+    """
+    def __init__(self, nodes, graph_data, sequence=0, deltas=(), history=60,
+                 history_bytes=4 * 1024 * 1024):
+        self.history = history
+        self.history_bytes = history_bytes
+        self.sequence = sequence
+        # (sequence, size) of the published deltas, oldest first
+        self.deltas = list(deltas)
+        self._snapshot(nodes, graph_data)
+
+    @classmethod
+    def load(cls, dest_dir, nodes, **kwargs):
+        """
+        Restore the feed from the files published by the previous run.
+        """
+        try:
+            with open(os.path.join(dest_dir, 'graph.json'), 'r') as f:
+                graph_data = json.load(f)['batadv']
+        except (IOError, ValueError, KeyError):
+            graph_data = {'nodes': [], 'links': []}
+
+        try:
+            with open(os.path.join(dest_dir, 'changes', 'index.json')) as f:
+                index = json.load(f)
+            sequence = index['sequence']
+            deltas = [(delta['sequence'], delta['size'])
+                      for delta in index['deltas']]
+        except (IOError, ValueError, KeyError):
+            sequence, deltas = 0, []
+            # continue the sequence of a feed without index
+            try:
+                with open(os.path.join(dest_dir, 'changes.json')) as f:
+                    sequence = json.load(f)['sequence']
+            except (IOError, ValueError, KeyError):
+                pass
+
+        return cls(nodes, graph_data, sequence, deltas, **kwargs)
+
+    def _snapshot(self, nodes, graph_data):
+        self._nodes = _snapshot_nodes(nodes)
+        self._links = _snapshot_links(graph_data)
+
+    def update(self, nodes, graph_data, now):
+        """
+        Compute the delta to the previous run and return it as JSON text.
+        """
+        links = _snapshot_links(graph_data)
+
+        self.sequence += 1
+        delta = json.dumps({'version': CHANGES_VERSION,
+                            'sequence': self.sequence,
+                            'timestamp': now.isoformat(),
+                            'nodes': diff_nodes(self._nodes, nodes),
+                            'links': diff_links(self._links, links)})
+
+        self.deltas.append((self.sequence, len(delta.encode('utf-8'))))
+        self.deltas = self.deltas[-self.history:]
+        # the newest delta is kept in any case
+        while len(self.deltas) > 1 and \
+                sum(size for _, size in self.deltas) > self.history_bytes:
+            self.deltas.pop(0)
+
+        self._nodes = _snapshot_nodes(nodes)
+        self._links = links
+
+        return delta
+
+    def publish(self, publisher, delta):
+        """
+        Publish delta, the JSON text returned by update(), as changes.json
+        and changes/<sequence>.json, together with the earlier deltas of the
+        history and changes/index.json.
+        """
+        publisher.write('changes.json', delta)
+
+        # only keep deltas following each other without a gap
+        kept = []
+        for sequence, size in self.deltas[:-1]:
+            if publisher.republish(_delta_name(sequence)):
+                kept.append((sequence, size))
+            else:
+                kept = []
+        publisher.write(_delta_name(self.sequence), delta)
+        self.deltas = kept + [(self.sequence, self.deltas[-1][1])]
+
+        publisher.write('changes/index.json', json.dumps(self.export_index()))
+
+    def export_index(self):
+        return {'version': CHANGES_VERSION,
+                'sequence': self.sequence,
+                'deltas': [{'sequence': sequence, 'size': size}
+                           for sequence, size in self.deltas]}
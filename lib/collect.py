@@ -0,0 +1,42 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.visdata import VisData
+
+
+def _fetch(f):
+    return list(f())
+
+
+def _fetch_vis_data(batman):
+    return VisData(batman.vis_data())
+
+
+def collect(alfred_instances, batman_instances, workers=None):
+    """
+    Run the data collection commands of all mesh instances concurrently.
+
+    Returns a tuple (alfred_data, mesh_info): a list of (nodeinfo, statistics)
+    per alfred instance and a list of (VisData, gateway_list) per batman
+    instance. At most `workers` commands run at the same time, by default
+    all of them do.
+    """
+    jobs = []
+    for alfred in alfred_instances:
+        jobs.extend([(_fetch, alfred.nodeinfo),
+                     (_fetch, alfred.statistics)])
+    for batman in batman_instances:
+        jobs.extend([(_fetch_vis_data, batman),
+                     (_fetch, batman.gateway_list)])
+
+    if not jobs:
+        return [], []
+
+    with ThreadPoolExecutor(max_workers=workers or len(jobs)) as executor:
+        futures = [executor.submit(f, arg) for f, arg in jobs]
+        results = [future.result() for future in futures]
+
+    alfred_results = results[:2 * len(alfred_instances)]
+    batman_results = results[2 * len(alfred_instances):]
+
+    return (list(zip(alfred_results[0::2], alfred_results[1::2])),
+            list(zip(batman_results[0::2], batman_results[1::2])))
@@ -0,0 +1,58 @@
+class DisjointSet(object):
+    """
+    Union-find over hashable items, with path compression and union by size.
+
+    Items are added implicitly by union(). Roots returned by find() or
+    roots() may stop being roots after further unions, but find() of a
+    former root still returns the current root of its component.
+    """
+    def __init__(self):
+        self._parent = dict()
+        self._size = dict()
+
+    def __contains__(self, item):
+        return item in self._parent
+
+    def __len__(self):
+        return len(self._parent)
+
+    def add(self, item):
+        if item not in self._parent:
+            self._parent[item] = item
+            self._size[item] = 1
+
+    def find(self, item):
+        """
+        Return the root of the component containing item.
+        """
+        parent = self._parent
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+
+        return root
+
+    def union(self, a, b):
+        self.add(a)
+        self.add(b)
+
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+
+        if self._size[a] < self._size[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._size[a] += self._size.pop(b)
+
+        return a
+
+    def roots(self, items):
+        """
+        Return the roots of all components containing any of items.
+        Items which have never been added are ignored.
+        """
+        return set(self.find(item) for item in items if item in self._parent)
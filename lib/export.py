@@ -0,0 +1,132 @@
+import json
+
+from lib.nodelist import export_node, export_nodelist
+from lib.nodes import json_default
+from lib.shards import export_index, export_index_node
+
+
+class _NodeWriter(object):
+    """
+    Writes a JSON document to a file like json.dump(document, f), but with
+    the value of its key 'nodes' written one node at a time by add().
+    close() writes the rest of the document.
+
+    Subclasses set the brackets of the nodes value and implement add().
+    """
+    brackets = '{}'
+
+    def __init__(self, f, document, default=None):
+        self._f = f
+        self._default = default
+        self._items = list(document.items())
+        self._keys = 0
+        self._nodes = 0
+
+        f.write('{')
+        self._write_items()
+
+    def _write_items(self):
+        while self._items:
+            key, value = self._items.pop(0)
+            self._f.write('{0}{1}: '.format(', ' if self._keys else '',
+                                            json.dumps(key)))
+            self._keys += 1
+
+            if key == 'nodes':
+                self._f.write(self.brackets[0])
+                return
+            self._f.write(json.dumps(value, default=self._default))
+
+        self._f.write('}')
+
+    def _write_node(self, text):
+        self._f.write(', ' + text if self._nodes else text)
+        self._nodes += 1
+
+    def close(self):
+        self._f.write(self.brackets[1])
+        self._write_items()
+
+
+class NodesWriter(_NodeWriter):
+    """
+    Writes nodedb as nodes.json, with the cached JSON of every node.
+    """
+    def __init__(self, f, nodedb):
+        super().__init__(f, nodedb, json_default)
+
+    def add(self, node_id, node):
+        self._write_node('{0}: {1}'.format(json.dumps(node_id),
+                                           node.export_json()))
+
+
+class NodelistWriter(_NodeWriter):
+    """
+    Writes nodelist.json like json.dump(export_nodelist(now, nodedb), f).
+    """
+    brackets = '[]'
+
+    def __init__(self, f, now):
+        super().__init__(f, export_nodelist(now, {'nodes': {}}))
+
+    def add(self, node_id, node):
+        self._write_node(json.dumps(export_node(node_id, node)))
+
+
+class IndexWriter(_NodeWriter):
+    """
+    Writes nodes-index.json like
+    json.dump(export_index(now, nodedb, shards), f).
+    """
+    brackets = '[]'
+
+    def __init__(self, f, now, shards):
+        super().__init__(f, export_index(now, {'nodes': {}}, shards))
+        self._shards = shards
+
+    def add(self, node_id, node):
+        self._write_node(json.dumps(export_index_node(node_id, node,
+                                                      self._shards)))
+
+
+def export_nodes(nodes, writers):
+    """
+    Write the files of all writers in one loop over nodes.
+    """
+    for node_id, node in nodes.items():
+        for writer in writers:
+            writer.add(node_id, node)
+
+    for writer in writers:
+        writer.close()
+
+
+def _dump_list(items, f):
+    f.write('[')
+    for i, item in enumerate(items):
+        f.write(', ' + json.dumps(item) if i else json.dumps(item))
+    f.write(']')
+
+
+def dump_graph(graph, f):
+    """
+    Write graph.json like json.dump(graph, f), one node or link of the
+    batadv graph at a time.
+    """
+    f.write('{')
+    for i, (key, value) in enumerate(graph.items()):
+        f.write('{0}{1}: '.format(', ' if i else '', json.dumps(key)))
+        if key != 'batadv':
+            f.write(json.dumps(value))
+            continue
+
+        f.write('{')
+        for j, (data_key, data) in enumerate(value.items()):
+            f.write('{0}{1}: '.format(', ' if j else '',
+                                      json.dumps(data_key)))
+            if data_key in ('nodes', 'links'):
+                _dump_list(data, f)
+            else:
+                f.write(json.dumps(data))
+        f.write('}')
+    f.write('}')
@@ -0,0 +1,94 @@
+"""
+Minimal stand-in for the alfred daemon, a tool for debugging the alfred
+client by hand. It answers requests on a unix socket with fixed data, so
+backend.py can be run without batman-adv and alfred:
+
+    python3 -m lib.fakealfred /tmp/alfred.sock 158=nodeinfo.json \
+        159=statistics.json
+
+Each JSON file holds an object mapping source MACs to records, the same
+format alfred-json prints.
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import socketserver
+
+from lib.alfred import ALFRED_PUSH_DATA, ALFRED_VERSION, DATA, REQUEST, \
+    TLV, TRANSACTION
+
+
+class FakeAlfredHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        with self.request.makefile('rb') as stream:
+            request = stream.read(REQUEST.size)
+        if len(request) != REQUEST.size:
+            return
+
+        _, _, _, data_type, tx_id = REQUEST.unpack(request)
+        records = self.server.data.get(data_type, {})
+
+        # like alfred, send one push data packet per record
+        for seqno, (mac, record) in enumerate(records.items()):
+            payload = self.server.encode(record)
+            data = DATA.pack(bytes.fromhex(mac.replace(':', '')),
+                             data_type, 0, len(payload)) + payload
+            self.request.sendall(b''.join([
+                TLV.pack(ALFRED_PUSH_DATA, ALFRED_VERSION,
+                         TRANSACTION.size + len(data)),
+                TRANSACTION.pack(tx_id, seqno),
+                data]))
+
+
+class FakeAlfredServer(socketserver.ThreadingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    Serves data, a dict mapping data types to dicts of source MAC and
+    record, on sockpath. Records are gzip compressed like gluon does unless
+    compress is False.
+    """
+    daemon_threads = True
+
+    def __init__(self, sockpath, data, compress=True):
+        self.data = data
+        self.compress = compress
+
+        if os.path.exists(sockpath):
+            os.unlink(sockpath)
+        super().__init__(sockpath, FakeAlfredHandler)
+
+    def encode(self, record):
+        payload = json.dumps(record).encode('utf-8')
+        if not self.compress:
+            return payload
+
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(payload)
+        return buf.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sockpath', help='unix socket to listen on')
+    parser.add_argument('sources', nargs='*', metavar='TYPE=FILE',
+                        help='serve records of data type TYPE from FILE')
+    parser.add_argument('--uncompressed', action='store_true',
+                        default=False,
+                        help='send records without gzip compression')
+    options = parser.parse_args()
+
+    data = dict()
+    for source in options.sources:
+        data_type, filename = source.split('=', 1)
+        with open(filename, 'r') as f:
+            data[int(data_type)] = json.load(f)
+
+    server = FakeAlfredServer(options.sockpath, data,
+                              compress=not options.uncompressed)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(options.sockpath)
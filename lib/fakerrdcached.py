@@ -0,0 +1,142 @@
+"""
+Minimal stand-in for rrdcached, a tool for debugging the RRD updates by
+hand. It speaks the part of the rrdcached protocol lib.rrdtool.RRDCached
+uses on a unix socket, so backend.py --rrdcached can be run without
+rrdcached:
+
+    python3 -m lib.fakerrdcached /tmp/rrdcached.sock
+
+Updates are kept in memory until they are flushed. Flushed updates are
+written with rrdtool if --write is given and otherwise only counted.
+"""
+import argparse
+import os
+import socketserver
+import subprocess
+import threading
+from collections import defaultdict
+
+
+class FakeRRDCachedHandler(socketserver.StreamRequestHandler):
+    def respond(self, status, message, lines=()):
+        self.wfile.write(''.join(
+            '{0}\n'.format(line)
+            for line in ['{0} {1}'.format(status, message)] + list(lines)
+        ).encode('utf-8'))
+
+    def handle(self):
+        for line in self.rfile:
+            command = line.decode('utf-8').rstrip('\n')
+            if command.upper() == 'QUIT':
+                return
+            if command.upper() == 'BATCH':
+                self.batch()
+            else:
+                self.respond(*self.server.execute(command))
+            self.wfile.flush()
+
+    def batch(self):
+        self.respond(0, "Go ahead.  End with dot '.' on its own line.")
+        self.wfile.flush()
+
+        errors = []
+        for number, line in enumerate(self.rfile, 1):
+            command = line.decode('utf-8').rstrip('\n')
+            if command == '.':
+                break
+            status, message = self.server.execute(command)[:2]
+            if status < 0:
+                errors.append('{0} {1}'.format(number, message))
+
+        self.respond(len(errors), 'errors', errors)
+
+
+class FakeRRDCachedServer(socketserver.ThreadingMixIn,
+                          socketserver.UnixStreamServer):
+    """
+    Serves the UPDATE, BATCH, FLUSH, FLUSHALL, PENDING, STATS and QUIT
+    commands on sockpath. pending maps file names to their queued values,
+    written counts the values flushed per file.
+    """
+    daemon_threads = True
+
+    def __init__(self, sockpath, write=False):
+        self.write = write
+        self.pending = defaultdict(list)
+        self.written = defaultdict(int)
+        self.lock = threading.Lock()
+
+        if os.path.exists(sockpath):
+            os.unlink(sockpath)
+        super().__init__(sockpath, FakeRRDCachedHandler)
+
+    def execute(self, command):
+        """
+        Run command, return (status, message, lines) of its answer.
+        """
+        name, _, args = command.partition(' ')
+        handler = getattr(self, 'do_' + name.lower(), None)
+        if handler is None:
+            return -1, 'Unknown command: {0}'.format(name), []
+
+        with self.lock:
+            return handler(args.split())
+
+    def do_update(self, args):
+        if len(args) < 2:
+            return -1, 'Usage: UPDATE <filename> <values> [<values> ...]', []
+        if not os.path.isfile(args[0]):
+            return -1, 'No such file: {0}'.format(args[0]), []
+
+        self.pending[args[0]].extend(args[1:])
+        return 0, 'errors, enqueued {0} value(s).'.format(len(args) - 1), []
+
+    def flush(self, filename):
+        values = self.pending.pop(filename, [])
+        if values and self.write:
+            subprocess.check_output(['rrdtool', 'update', filename] + values)
+        self.written[filename] += len(values)
+
+    def do_flush(self, args):
+        if len(args) != 1:
+            return -1, 'Usage: FLUSH <filename>', []
+        if args[0] in self.pending:
+            self.flush(args[0])
+            return 0, 'Successfully flushed {0}.'.format(args[0]), []
+        if os.path.isfile(args[0]):
+            return 0, 'Nothing to flush: {0}.'.format(args[0]), []
+
+        return -1, 'No such file: {0}.'.format(args[0]), []
+
+    def do_flushall(self, args):
+        for filename in list(self.pending):
+            self.flush(filename)
+        return 0, 'Started flush.', []
+
+    def do_pending(self, args):
+        if len(args) != 1:
+            return -1, 'Usage: PENDING <filename>', []
+        values = self.pending.get(args[0], [])
+        return len(values), 'updates pending', values
+
+    def do_stats(self, args):
+        pending = sum(map(len, self.pending.values()))
+        written = sum(self.written.values())
+        lines = ['QueueLength: {0}'.format(len(self.pending)),
+                 'UpdatesReceived: {0}'.format(pending + written),
+                 'DataSetsWritten: {0}'.format(written)]
+        return len(lines), 'Statistics follow', lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sockpath', help='unix socket to listen on')
+    parser.add_argument('--write', action='store_true', default=False,
+                        help='write flushed updates with rrdtool')
+    options = parser.parse_args()
+
+    server = FakeRRDCachedServer(options.sockpath, write=options.write)
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(options.sockpath)
@@ -0,0 +1,88 @@
+def _jq_number(value):
+    """
+    Format value like jq does in string interpolation, e.g. 1.0 as "1".
+    """
+    text = repr(value)
+    if text.endswith('.0'):
+        text = text[:-2]
+    return text
+
+
+def _clientcount(clients):
+    if isinstance(clients, (int, float)) and not isinstance(clients, bool):
+        return clients if clients >= 0 else 0
+    # jq sorts null and booleans before numbers, everything else after them
+    return clients if clients not in (None, True, False) else 0
+
+
+def _node(graph_node, node):
+    if node is None:
+        # a node id without a node, as looked up by jq
+        return {'id': graph_node['id'],
+                'uptime': None,
+                'flags': {'client': False},
+                'name': None,
+                'clientcount': 0,
+                'hardware': None,
+                'firmware': None,
+                'geo': None,
+                'network': None}
+
+    nodeinfo = node.nodeinfo
+    location = nodeinfo.get('location')
+    geo = None
+    if location is not None and location is not False:
+        geo = [location.get('latitude'), location.get('longitude')]
+
+    flags = node.flags
+    flags['client'] = False
+
+    return {'id': graph_node['id'],
+            'uptime': node.statistics.get('uptime'),
+            'flags': flags,
+            'name': nodeinfo.get('hostname'),
+            'clientcount': _clientcount(node.statistics.get('clients')),
+            'hardware': (nodeinfo.get('hardware') or {}).get('model'),
+            'firmware': ((nodeinfo.get('software') or {})
+                         .get('firmware') or {}).get('release'),
+            'geo': geo,
+            'network': nodeinfo.get('network')}
+
+
+def export_ffmap_d3(nodedb, graph):
+    """
+    Return the data of the old ffmap-d3 front end, as converted from
+    nodes.json and graph.json by ffmap-d3.jq. graph is the batadv graph in
+    node_link_data format.
+    """
+    nodes = nodedb['nodes']
+    graph_nodes = graph['nodes']
+
+    nodes_out = list()
+    for graph_node in graph_nodes:
+        node_id = graph_node.get('node_id')
+        if node_id is not None:
+            nodes_out.append(_node(graph_node, nodes.get(node_id)))
+        else:
+            nodes_out.append({'flags': {},
+                              'id': graph_node['id'],
+                              'geo': None,
+                              'clientcount': 0})
+
+    links_out = list()
+    for link in graph['links']:
+        source_id = graph_nodes[link['source']].get('node_id')
+        target_id = graph_nodes[link['target']].get('node_id')
+        if source_id not in nodes or target_id not in nodes:
+            continue
+
+        quality = _jq_number(link['tq'])
+        links_out.append({'target': link['target'],
+                          'source': link['source'],
+                          'quality': '{0}, {0}'.format(quality),
+                          'id': source_id + '-' + target_id,
+                          'type': 'vpn' if link['vpn'] else None})
+
+    return {'meta': {'timestamp': nodedb['timestamp']},
+            'nodes': nodes_out,
+            'links': links_out}
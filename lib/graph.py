@@ -1,85 +1,113 @@
-from functools import reduce
-from itertools import chain
-
-import networkx as nx
-
-from lib.nodes import build_mac_table
-
-
-def import_vis_data(graph, nodes, vis_data):
-    macs = build_mac_table(nodes)
-    nodes_a = map(lambda d: 2 * [d['primary']],
-                  filter(lambda d: 'primary' in d, vis_data))
-    nodes_b = map(lambda d: [d['secondary'], d['of']],
-                  filter(lambda d: 'secondary' in d, vis_data))
-    graph.add_nodes_from(map(lambda a, b:
-                             (a, dict(primary=b, node_id=macs.get(b))),
-                             *zip(*chain(nodes_a, nodes_b))))
-
-    edges = filter(lambda d: 'neighbor' in d, vis_data)
-    graph.add_edges_from(map(lambda d: (d['router'], d['neighbor'],
-                                        dict(tq=float(d['label']))), edges))
-
-
-def mark_vpn(graph, vpn_macs):
-    components = map(frozenset, nx.weakly_connected_components(graph))
-    components = filter(vpn_macs.intersection, components)
-    nodes = reduce(lambda a, b: a | b, components, set())
-
-    for node in nodes:
-        for k, v in graph[node].items():
-            v['vpn'] = True
-
-
-def to_multigraph(graph):
-    def f(a):
-        node = graph.node[a]
-        return node['primary'] if node else a
-
-    def map_node(node, data):
-        return (data['primary'],
-                dict(node_id=data['node_id'])) if data else (node, dict())
-
-    digraph = nx.MultiDiGraph()
-    digraph.add_nodes_from(map(map_node, *zip(*graph.nodes_iter(data=True))))
-    digraph.add_edges_from(map(lambda a, b, data: (f(a), f(b), data),
-                               *zip(*graph.edges_iter(data=True))))
-
-    return digraph
-
-
-def merge_nodes(graph):
-    def merge_edges(data):
-        tq = min(map(lambda d: d['tq'], data))
-        vpn = all(map(lambda d: d.get('vpn', False), data))
-        return dict(tq=tq, vpn=vpn)
-
-    multigraph = to_multigraph(graph)
-    digraph = nx.DiGraph()
-    digraph.add_nodes_from(multigraph.nodes_iter(data=True))
-    edges = chain.from_iterable([[(e, d, merge_edges(
-        multigraph[e][d].values()))
-        for d in multigraph[e]] for e in multigraph])
-    digraph.add_edges_from(edges)
-
-    return digraph
-
-
-def to_undirected(graph):
-    multigraph = nx.MultiGraph()
-    multigraph.add_nodes_from(graph.nodes_iter(data=True))
-    multigraph.add_edges_from(graph.edges_iter(data=True))
-
-    def merge_edges(data):
-        tq = max(map(lambda d: d['tq'], data))
-        vpn = all(map(lambda d: d.get('vpn', False), data))
-        return dict(tq=tq, vpn=vpn, bidirect=len(data) == 2)
-
-    graph = nx.Graph()
-    graph.add_nodes_from(multigraph.nodes_iter(data=True))
-    edges = chain.from_iterable([[(e, d, merge_edges(
-        multigraph[e][d].values()))
-        for d in multigraph[e]] for e in multigraph])
-    graph.add_edges_from(edges)
-
-    return graph
+from collections import defaultdict
+
+from lib.disjointset import DisjointSet
+
+
+class BatadvGraph(object):
+    """
+    The batman-adv mesh as seen in the vis data of one run.
+
+    Interface level vis edges are collected once and folded into links
+    between primary MACs when the graph is exported: parallel directed edges
+    keep their minimum tq, both directions of a link are merged into an
+    undirected link with the maximum tq, and a link is a vpn link if all of
+    its edges belong to a component that contains a vpn MAC.
+
+    Components of the interface level graph are tracked in a disjoint set
+    while edges are imported. Flags like 'vpn' are attached to components,
+    so any number of MAC sets can be checked without recomputing them.
+    """
+    def __init__(self):
+        # interface MAC -> (primary MAC, node_id), None if unknown
+        self._interfaces = dict()
+        # (router, neighbor) -> tq
+        self._edges = dict()
+        self._components = DisjointSet()
+        # flag -> roots of flagged components
+        self._component_flags = defaultdict(set)
+
+    def import_vis_data(self, macs, vis_data):
+        for mac in vis_data.primaries:
+            self._interfaces[mac] = (mac, macs.get(mac))
+        for mac, primary in vis_data.secondaries.items():
+            self._interfaces[mac] = (primary, macs.get(primary))
+
+        for router, neighbor, tq in vis_data.edges:
+            self._interfaces.setdefault(router, None)
+            self._interfaces.setdefault(neighbor, None)
+            self._edges[(router, neighbor)] = tq
+            self._components.union(router, neighbor)
+
+    def flag_components(self, flag, macs):
+        """
+        Set flag on all components containing any of macs.
+        """
+        self._component_flags[flag].update(self._components.roots(macs))
+
+    def flagged_components(self, flag):
+        """
+        Return the current roots of all components flagged with flag.
+        """
+        return self._components.roots(self._component_flags[flag])
+
+    def mark_vpn(self, vpn_macs):
+        """
+        Mark all links in components containing any of vpn_macs as vpn.
+        """
+        self.flag_components('vpn', vpn_macs)
+
+    def _primary(self, mac):
+        interface = self._interfaces[mac]
+        return interface[0] if interface else mac
+
+    def node_link_data(self):
+        """
+        Return the graph in networkx' node_link_data format.
+        """
+        nodes = dict()
+        for mac, interface in self._interfaces.items():
+            node = nodes.setdefault(self._primary(mac), dict())
+            if interface:
+                node['node_id'] = interface[1]
+
+        vpn_components = self.flagged_components('vpn')
+
+        # merge parallel edges between the same primaries
+        edges = dict()
+        for (router, neighbor), tq in self._edges.items():
+            key = (self._primary(router), self._primary(neighbor))
+            vpn = self._components.find(router) in vpn_components
+            if key in edges:
+                edge = edges[key]
+                edges[key] = (min(edge[0], tq), edge[1] and vpn)
+            else:
+                edges[key] = (tq, vpn)
+
+        # merge both directions into one link
+        links = dict()
+        for (a, b), (tq, vpn) in edges.items():
+            key = (b, a) if (b, a) in links else (a, b)
+            if key in links:
+                link = links[key]
+                link['tq'] = max(link['tq'], tq)
+                link['vpn'] = link['vpn'] and vpn
+                link['bidirect'] = True
+            else:
+                links[key] = dict(tq=tq, vpn=vpn, bidirect=False)
+
+        index = dict(map(reversed, enumerate(nodes)))
+
+        return {'directed': False,
+                'multigraph': False,
+                'graph': {},
+                'nodes': [dict(data, id=mac) for mac, data in nodes.items()],
+                'links': [dict(data, source=index[a], target=index[b])
+                          for (a, b), data in links.items()]}
+
+    def to_networkx(self):
+        """
+        Return the graph as networkx.Graph for further analysis.
+        """
+        from networkx.readwrite import json_graph
+
+        return json_graph.node_link_graph(self.node_link_data())
@@ -1,24 +1,29 @@
-def export_nodelist(now, nodedb):
-    nodelist = list()
+from lib.nodes import isotime
+
+
+def export_node(node_id, node):
+    node_out = dict()
+    node_out["id"] = node_id
+    node_out["name"] = node.nodeinfo["hostname"]
 
-    for node_id, node in nodedb["nodes"].items():
-        node_out = dict()
-        node_out["id"] = node_id
-        node_out["name"] = node["nodeinfo"]["hostname"]
+    if "location" in node.nodeinfo:
+        node_out["position"] = {"lat": node.nodeinfo["location"]["latitude"],
+                                "long": node.nodeinfo["location"]["longitude"]}
 
-        if "location" in node["nodeinfo"]:
-            node_out["position"] = {"lat": node["nodeinfo"]["location"]["latitude"],
-                                    "long": node["nodeinfo"]["location"]["longitude"]}
+    node_out["status"] = dict()
+    node_out["status"]["online"] = node.online
 
-        node_out["status"] = dict()
-        node_out["status"]["online"] = node["flags"]["online"]
+    if node.lastseen is not None:
+        node_out["status"]["lastcontact"] = isotime(node.lastseen)
 
-        if "lastseen" in node:
-            node_out["status"]["lastcontact"] = node["lastseen"]
+    if "clients" in node.statistics:
+        node_out["status"]["clients"] = node.statistics["clients"]
 
-        if "clients" in node["statistics"]:
-            node_out["status"]["clients"] = node["statistics"]["clients"]
+    return node_out
 
-        nodelist.append(node_out)
+
+def export_nodelist(now, nodedb):
+    nodelist = [export_node(node_id, node)
+                for node_id, node in nodedb["nodes"].items()]
 
     return {"version": "1.0.1", "nodes": nodelist, "updated_at": now.isoformat()}
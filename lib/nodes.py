@@ -1,87 +1,427 @@
-from collections import Counter, defaultdict
+import calendar
+import hashlib
+import json
+import sys
+from collections import Counter, OrderedDict
 from datetime import datetime
 from functools import reduce
 
-
-def build_mac_table(nodes):
-    macs = dict()
-    for node_id, node in nodes.items():
-        try:
-            for mac in node['nodeinfo']['network']['mesh_interfaces']:
-                macs[mac] = node_id
-        except KeyError:
-            pass
-
+# bits of Node flags
+ONLINE = 1
+GATEWAY = 2
+# nodeinfo was read from nodes.json, with mesh interfaces merged into it
+RESTORED = 8
+
+
+def timestamp(dt):
+    """
+    Return the unix timestamp of the naive UTC datetime dt.
+    """
+    return calendar.timegm(dt.utctimetuple())
+
+
+def parse_time(value):
+    """
+    Return the unix timestamp of an ISO 8601 UTC time like
+    2015-03-01T12:00:00, much faster than strptime.
+    """
+    return calendar.timegm((int(value[0:4]), int(value[5:7]),
+                            int(value[8:10]), int(value[11:13]),
+                            int(value[14:16]), int(value[17:19])))
+
+
+def isotime(epoch):
+    return datetime.utcfromtimestamp(epoch).isoformat()
+
+
+def mac_to_int(mac):
+    """
+    Return the MAC address aa:bb:cc:dd:ee:ff as a 48 bit integer, raises
+    ValueError if it is none.
+    """
+    try:
+        return int(mac.replace(':', ''), 16)
+    except AttributeError:
+        raise ValueError('invalid MAC address {0!r}'.format(mac))
+
+
+def _intern(value):
+    """
+    Return a copy of the JSON data value with all strings interned, so
+    models, firmware versions etc. are shared between nodes.
+    """
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, dict):
+        return dict((sys.intern(k), _intern(v)) for k, v in value.items())
+    if isinstance(value, list):
+        return [_intern(v) for v in value]
+    return value
+
+
+def nodeinfo_fingerprint(nodeinfo):
+    data = json.dumps(nodeinfo, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).digest()
+
+
+def _merge_mesh_interfaces(nodeinfo, macs):
+    """
+    Return a copy of nodeinfo with macs added to its mesh_interfaces.
+    """
+    merged = dict(nodeinfo)
+    merged['network'] = dict(nodeinfo.get('network', {}))
+    merged['network']['mesh_interfaces'] = sorted(
+        set(mesh_macs(nodeinfo)).union(macs))
+    return merged
+
+
+class Node(object):
+    """
+    A node of nodedb['nodes'].
+
+    Flags are packed into an int, lastseen and firstseen are unix timestamps
+    (None if unknown) and the strings of nodeinfo are interned. export()
+    returns the node as it is written to nodes.json:
+
+        {'flags': {'online': bool, 'gateway': bool},
+         'nodeinfo': {...},
+         'lastseen': '2015-03-01T12:00:00',    # if known
+         'firstseen': '2015-03-01T12:00:00',   # if known
+         'statistics': {...}}
+
+    update_nodeinfo() keeps the nodeinfo received from the node as long as
+    its fingerprint stays the same, and records when it changed. Mesh
+    interfaces found in vis data are merged into a copy of it, which is
+    kept as long as they stay the same, too. So nodeinfo is only a new
+    object if its content changed, and data derived from it (like the MAC
+    index entries or its JSON) is cached until then. nodeinfo dicts must
+    not be changed in place.
+
+    nodeinfo_changed tells whether nodeinfo changed since it was last
+    cleared, which is done once the outputs are written.
+    """
+    __slots__ = ('_flags', '_received', '_vis', '_merged', '_merged_vis',
+                 '_json', '_json_of', '_exported', 'fingerprint',
+                 'nodeinfo_changed_at', 'statistics', 'lastseen', 'firstseen')
+
+    def __init__(self, nodeinfo=None):
+        self._flags = 0
+        self.nodeinfo = nodeinfo if nodeinfo is not None else dict()
+        self.fingerprint = None
+        self.nodeinfo_changed_at = None
+        self.statistics = dict()
+        self.lastseen = None
+        self.firstseen = None
+        self._json = self._json_of = None
+        self._exported = None
+
+    def _set_flag(self, bit, value):
+        if value:
+            self._flags |= bit
+        else:
+            self._flags &= ~bit
+
+    @property
+    def online(self):
+        return bool(self._flags & ONLINE)
+
+    @online.setter
+    def online(self, value):
+        self._set_flag(ONLINE, value)
+
+    @property
+    def gateway(self):
+        return bool(self._flags & GATEWAY)
+
+    @gateway.setter
+    def gateway(self, value):
+        self._set_flag(GATEWAY, value)
+
+    @property
+    def nodeinfo_changed(self):
+        """
+        Whether nodeinfo changed since nodeinfo_changed was set to False,
+        by update_nodeinfo() or by merging other mesh interfaces into it.
+        """
+        return self.nodeinfo is not self._exported
+
+    @nodeinfo_changed.setter
+    def nodeinfo_changed(self, value):
+        self._exported = None if value else self.nodeinfo
+
+    @property
+    def flags(self):
+        return {'online': self.online, 'gateway': self.gateway}
+
+    @property
+    def nodeinfo(self):
+        if self._vis is None:
+            return self._received
+        if self._merged_vis != self._vis:
+            self._merged = _merge_mesh_interfaces(self._received, self._vis)
+            self._merged_vis = self._vis
+        return self._merged
+
+    @nodeinfo.setter
+    def nodeinfo(self, nodeinfo):
+        self._received = nodeinfo
+        self._vis = self._merged = self._merged_vis = None
+
+    def update_nodeinfo(self, nodeinfo, now):
+        """
+        Set the nodeinfo received from the node at now, dropping the mesh
+        interfaces merged into the previous one. Returns whether it changed.
+        """
+        fingerprint = nodeinfo_fingerprint(nodeinfo)
+        changed = fingerprint != self.fingerprint
+        if changed and self._flags & RESTORED and \
+                self.fingerprint is not None:
+            # nodeinfo read from nodes.json holds the mesh interfaces merged
+            # into it, so compare it to nodeinfo with them merged
+            merged = _merge_mesh_interfaces(nodeinfo,
+                                            mesh_macs(self._received))
+            changed = nodeinfo_fingerprint(merged) != self.fingerprint
+        # restored nodeinfo may hold merged mesh interfaces
+        if changed or self._flags & RESTORED:
+            self.nodeinfo = _intern(nodeinfo)
+            self.fingerprint = fingerprint
+            self._set_flag(RESTORED, False)
+        if changed:
+            self.nodeinfo_changed_at = timestamp(now)
+
+        self._vis = None
+        return changed
+
+    def merge_mesh_interfaces(self, macs):
+        """
+        Add the MACs found in vis data to nodeinfo's mesh_interfaces.
+        """
+        self._vis = frozenset(macs).union(self._vis or ())
+
+    def nodeinfo_json(self):
+        """
+        Return json.dumps(self.nodeinfo), cached until nodeinfo changes.
+        """
+        nodeinfo = self.nodeinfo
+        if self._json_of is not nodeinfo:
+            self._json = json.dumps(nodeinfo)
+            self._json_of = nodeinfo
+        return self._json
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Return the Node of a node read from nodes.json.
+        """
+        node = cls(_intern(data.get('nodeinfo', {})))
+        node._set_flag(RESTORED, True)
+        flags = data.get('flags', {})
+        node.online = flags.get('online', False)
+        node.gateway = flags.get('gateway', False)
+        node.statistics = data.get('statistics', {})
+        if 'lastseen' in data:
+            node.lastseen = parse_time(data['lastseen'])
+        if 'firstseen' in data:
+            node.firstseen = parse_time(data['firstseen'])
+        return node
+
+    def export(self):
+        data = {'flags': self.flags, 'nodeinfo': self.nodeinfo}
+        if self.lastseen is not None:
+            data['lastseen'] = isotime(self.lastseen)
+        if self.firstseen is not None:
+            data['firstseen'] = isotime(self.firstseen)
+        data['statistics'] = self.statistics
+        return data
+
+    def export_json(self):
+        """
+        Return json.dumps(self.export()), using the cached nodeinfo JSON.
+        """
+        parts = ['{"flags": ', json.dumps(self.flags),
+                 ', "nodeinfo": ', self.nodeinfo_json()]
+        if self.lastseen is not None:
+            parts.extend([', "lastseen": "', isotime(self.lastseen), '"'])
+        if self.firstseen is not None:
+            parts.extend([', "firstseen": "', isotime(self.firstseen), '"'])
+        parts.extend([', "statistics": ', json.dumps(self.statistics), '}'])
+        return ''.join(parts)
+
+    # pickles smaller and faster than the default state of __slots__, the
+    # caches are left out
+    def __getstate__(self):
+        return (self._flags, self._received, self._vis, self.fingerprint,
+                self.nodeinfo_changed_at, self.statistics, self.lastseen,
+                self.firstseen)
+
+    def __setstate__(self, state):
+        (self._flags, self._received, self._vis, self.fingerprint,
+         self.nodeinfo_changed_at, self.statistics, self.lastseen,
+         self.firstseen) = state
+        self._merged = self._merged_vis = None
+        self._json = self._json_of = None
+        self._exported = None
+
+
+def json_default(obj):
+    """
+    default for json.dump, writes Nodes in their nodes.json form.
+    """
+    if isinstance(obj, Node):
+        return obj.export()
+    raise TypeError('{0!r} is not JSON serializable'.format(obj))
+
+
+def load_nodes(nodes):
+    """
+    Return the Nodes of the nodes dict read from nodes.json.
+
+    nodes.json holds neither fingerprints nor change times, so the
+    fingerprints are computed from the restored nodeinfo. Nodes with mesh
+    interfaces merged into it still count as changed once.
+    """
+    nodes = dict((node_id, Node.from_json(node))
+                 for node_id, node in nodes.items())
+    for node in nodes.values():
+        node.fingerprint = nodeinfo_fingerprint(node.nodeinfo)
+
+    return nodes
+
+
+def mesh_macs(nodeinfo):
+    """
+    Yield all mesh interface MACs announced in nodeinfo, for every mesh
+    interface name and interface type.
+    """
+    network = nodeinfo.get('network', {})
+    yield from network.get('mesh_interfaces', [])
+
+    for mesh in network.get('mesh', {}).values():
+        for macs in mesh.get('interfaces', {}).values():
+            yield from macs
+
+
+class MacIndex(object):
+    """
+    Maps mesh interface MACs to node ids. MACs are stored as integers, but
+    looked up as strings.
+
+    The index is built once and then kept up to date by import_nodeinfo,
+    import_mesh_ifs_vis_data and prune_nodes. Nodes whose nodeinfo is the
+    same object as last time are not looked at again.
+    """
+    def __init__(self, nodes=None):
+        self._macs = dict()
+        self._node_macs = dict()
+
+        if nodes:
+            for node_id, node in nodes.items():
+                self.update_node(node_id, node)
+
+    def update_node(self, node_id, node):
+        # unchanged, as the nodeinfo of a Node is never changed in place
+        nodeinfo = node.nodeinfo
+        if self._node_macs.get(node_id, (None,))[0] is nodeinfo:
+            return
+
+        self.remove_node(node_id)
+
+        macs = set()
+        for mac in mesh_macs(nodeinfo):
+            try:
+                macs.add(mac_to_int(mac))
+            except ValueError:
+                pass
+        self._node_macs[node_id] = (nodeinfo, macs)
+        for mac in macs:
+            self._macs[mac] = node_id
+
+    def remove_node(self, node_id):
+        for mac in self._node_macs.pop(node_id, (None, ()))[1]:
+            if self._macs.get(mac) == node_id:
+                del self._macs[mac]
+
+    def get(self, mac, default=None):
         try:
-            for mac in node['nodeinfo']['network']['mesh']['bat0']['interfaces']['wireless']:
-                macs[mac] = node_id
-        except KeyError:
-            pass
+            return self._macs.get(mac_to_int(mac), default)
+        except ValueError:
+            return default
 
+    def __getitem__(self, mac):
         try:
-            for mac in node['nodeinfo']['network']['mesh']['bat0']['interfaces']['tunnel']:
-                macs[mac] = node_id
-        except KeyError:
-            pass
+            return self._macs[mac_to_int(mac)]
+        except ValueError:
+            raise KeyError(mac)
 
+    def __contains__(self, mac):
         try:
-            for mac in node['nodeinfo']['network']['mesh']['bat0']['interfaces']['other']:
-                macs[mac] = node_id
-        except KeyError:
-            pass
+            return mac_to_int(mac) in self._macs
+        except ValueError:
+            return False
 
-    return macs
+    def __len__(self):
+        return len(self._macs)
 
 
-def prune_nodes(nodes, now, days):
-    prune = []
-    for node_id, node in nodes.items():
-        if 'lastseen' not in node:
-            prune.append(node_id)
-            continue
-
-        lastseen = datetime.strptime(node['lastseen'], '%Y-%m-%dT%H:%M:%S')
-        delta = (now - lastseen).days
-
-        if delta >= days:
-            prune.append(node_id)
+def prune_nodes(nodes, macs, now, days):
+    cutoff = timestamp(now) - days * 86400
+    prune = [node_id for node_id, node in nodes.items()
+             if node.lastseen is None or node.lastseen <= cutoff]
 
     for node_id in prune:
         del nodes[node_id]
+        macs.remove_node(node_id)
 
 
 def mark_online(node, now):
-    node['lastseen'] = now.isoformat()
-    node.setdefault('firstseen', now.isoformat())
-    node['flags']['online'] = True
-
-
-def import_nodeinfo(nodes, nodeinfos, now, assume_online=False):
-    for nodeinfo in filter(lambda d: 'node_id' in d, nodeinfos):
-        node = nodes.setdefault(nodeinfo['node_id'], {'flags': dict()})
-        node['nodeinfo'] = nodeinfo
-        node['flags']['online'] = False
-        node['flags']['gateway'] = False
-
-        if assume_online:
-            mark_online(node, now)
+    node.lastseen = timestamp(now)
+    if node.firstseen is None:
+        node.firstseen = node.lastseen
+    node.online = True
+
+
+def import_nodeinfo(nodes, macs, sources, now):
+    """
+    Import the nodeinfo of sources, a list of (nodeinfos, assume_online)
+    in the order they apply. A node in several sources gets the nodeinfo
+    of the last one (so aliases replace what the node sent), which is only
+    then passed to update_nodeinfo(), once per run.
+    """
+    # node id -> nodeinfo, in the order of their last import
+    latest = OrderedDict()
+    for nodeinfos, assume_online in sources:
+        for nodeinfo in filter(lambda d: 'node_id' in d, nodeinfos):
+            node = nodes.get(nodeinfo['node_id'])
+            if node is None:
+                node = nodes[nodeinfo['node_id']] = Node()
+            latest.pop(nodeinfo['node_id'], None)
+            latest[nodeinfo['node_id']] = nodeinfo
+            node.online = False
+            node.gateway = False
+
+            if assume_online:
+                mark_online(node, now)
+
+    for node_id, nodeinfo in latest.items():
+        node = nodes[node_id]
+        node.update_nodeinfo(nodeinfo, now)
+        macs.update_node(node_id, node)
 
 
 def reset_statistics(nodes):
     for node in nodes.values():
-        node['statistics'] = {'clients': 0}
+        node.statistics = {'clients': 0}
 
 
-def import_statistics(nodes, stats):
+def import_statistics(nodes, macs, stats):
     def add(node, statistics, target, source, f=lambda d: d):
         try:
-            node['statistics'][target] = f(reduce(dict.__getitem__,
-                                                  source,
-                                                  statistics))
+            node.statistics[target] = f(reduce(dict.__getitem__,
+                                               source,
+                                               statistics))
         except (KeyError, TypeError, ZeroDivisionError):
             pass
 
-    macs = build_mac_table(nodes)
     stats = filter(lambda d: 'node_id' in d, stats)
     stats = filter(lambda d: d['node_id'] in nodes, stats)
     for node, stats in map(lambda d: (nodes[d['node_id']], d), stats):
@@ -95,18 +435,12 @@ def import_statistics(nodes, stats):
         add(node, stats, 'traffic', ['traffic'])
 
 
-def import_mesh_ifs_vis_data(nodes, vis_data):
-    macs = build_mac_table(nodes)
-
-    mesh_ifs = defaultdict(lambda: set())
-    for line in filter(lambda d: 'secondary' in d, vis_data):
-        primary = line['of']
-        mesh_ifs[primary].add(primary)
-        mesh_ifs[primary].add(line['secondary'])
+def import_mesh_ifs_vis_data(nodes, macs, vis_data):
+    mesh_ifs = vis_data.mesh_interfaces()
 
     def if_to_node(ifs):
         a = filter(lambda d: d in macs, ifs)
-        a = map(lambda d: nodes[macs[d]], a)
+        a = map(lambda d: macs[d], a)
         try:
             return next(a), ifs
         except StopIteration:
@@ -114,65 +448,32 @@ def import_mesh_ifs_vis_data(nodes, vis_data):
 
     mesh_nodes = filter(lambda d: d, map(if_to_node, mesh_ifs.values()))
 
-    for v in mesh_nodes:
-        node = v[0]
+    for node_id, vis_ifs in mesh_nodes:
+        node = nodes[node_id]
+        node.merge_mesh_interfaces(vis_ifs)
+        macs.update_node(node_id, node)
 
-        ifs = set()
 
-        try:
-            ifs = ifs.union(set(node['nodeinfo']['network']['mesh_interfaces']))
-        except KeyError:
-            pass
-
-        try:
-            ifs = ifs.union(set(node['nodeinfo']['network']['mesh']['bat0']['interfaces']['wireless']))
-        except KeyError:
-            pass
-
-        try:
-            ifs = ifs.union(set(node['nodeinfo']['network']['mesh']['bat0']['interfaces']['tunnel']))
-        except KeyError:
-            pass
-
-        try:
-            ifs = ifs.union(set(node['nodeinfo']['network']['mesh']['bat0']['interfaces']['other']))
-        except KeyError:
-            pass
-
-        node['nodeinfo']['network']['mesh_interfaces'] = list(ifs | v[1])
+def import_vis_clientcount(nodes, macs, vis_data):
+    data = filter(lambda d: d[0] in macs, vis_data.clients.items())
 
+    clientcounts = Counter()
+    for router, clientcount in data:
+        clientcounts[macs[router]] += clientcount
 
-def import_vis_clientcount(nodes, vis_data):
-    macs = build_mac_table(nodes)
-    data = filter(lambda d: d.get('label', None) == 'TT', vis_data)
-    data = filter(lambda d: d['router'] in macs, data)
-    data = map(lambda d: macs[d['router']], data)
+    for node_id, clientcount in clientcounts.items():
+        nodes[node_id].statistics.setdefault('clients', clientcount)
 
-    for node_id, clientcount in Counter(data).items():
-        nodes[node_id]['statistics'].setdefault('clients', clientcount)
 
-
-def mark_gateways(nodes, gateways):
-    macs = build_mac_table(nodes)
+def mark_gateways(nodes, macs, gateways):
     gateways = filter(lambda d: d in macs, gateways)
 
     for node in map(lambda d: nodes[macs[d]], gateways):
-        node['flags']['gateway'] = True
-
-
-def mark_vis_data_online(nodes, vis_data, now):
-    macs = build_mac_table(nodes)
-
-    online = set()
-    for line in vis_data:
-        if 'primary' in line:
-            online.add(line['primary'])
-        elif 'secondary' in line:
-            online.add(line['secondary'])
-        elif 'gateway' in line:
-            # This matches clients' MACs.
-            # On pre-Gluon nodes the primary MAC will be one of it.
-            online.add(line['gateway'])
+        node.gateway = True
+
+
+def mark_vis_data_online(nodes, macs, vis_data, now):
+    online = vis_data.online_macs()
 
     for mac in filter(lambda d: d in macs, online):
         mark_online(nodes[macs[mac]], now)
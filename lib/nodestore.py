@@ -0,0 +1,170 @@
+import json
+import os
+import sqlite3
+
+from lib.nodes import Node, isotime, parse_time, timestamp
+
+NODESTORE_VERSION = 2
+
+_COLUMNS = ('flags', 'nodeinfo', 'statistics', 'lastseen', 'firstseen',
+            'fingerprint', 'nodeinfo_changed_at')
+
+
+def _dumps(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def _row(node):
+    """
+    Return the column values of node, as in nodes.json. flags and
+    statistics are dumped with sorted keys, nodeinfo is the cached JSON of
+    the node, so unchanged data gives equal rows.
+    """
+    return (_dumps(node.flags),
+            node.nodeinfo_json(),
+            _dumps(node.statistics),
+            isotime(node.lastseen) if node.lastseen is not None else None,
+            isotime(node.firstseen) if node.firstseen is not None else None,
+            node.fingerprint,
+            node.nodeinfo_changed_at)
+
+
+def _node(row):
+    (flags, nodeinfo, statistics, lastseen, firstseen, fingerprint,
+     nodeinfo_changed_at) = row
+
+    node = Node.from_json({'flags': json.loads(flags),
+                           'nodeinfo': json.loads(nodeinfo),
+                           'statistics': json.loads(statistics)})
+    if lastseen is not None:
+        node.lastseen = parse_time(lastseen)
+    if firstseen is not None:
+        node.firstseen = parse_time(firstseen)
+    node.fingerprint = fingerprint
+    node.nodeinfo_changed_at = nodeinfo_changed_at
+    return node
+
+
+class NodeStore(object):
+    """
+    Keeps the nodes of nodedb in an SQLite database, one row per node.
+
+    The rows hold the nodes as in nodes.json. save() writes the rows which
+    changed since load() or the last save() in one transaction. lastseen is
+    indexed, so prune() doesn't need to look at every node.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        # whether the database has just been created
+        self.created = not os.path.exists(filename)
+        self._db = sqlite3.connect(filename)
+        # node id -> row as last loaded or saved
+        self._rows = dict()
+
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                             '(key TEXT PRIMARY KEY, value)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS nodes '
+                             '(node_id TEXT PRIMARY KEY, flags TEXT, '
+                             'nodeinfo TEXT, statistics TEXT, lastseen TEXT, '
+                             'firstseen TEXT, fingerprint BLOB, '
+                             'nodeinfo_changed_at INTEGER)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS nodes_lastseen '
+                             'ON nodes (lastseen)')
+
+            version = self._db.execute(
+                "SELECT value FROM meta WHERE key = 'version'").fetchone()
+            if version is None:
+                self._db.execute("INSERT INTO meta VALUES ('version', ?)",
+                                 (NODESTORE_VERSION,))
+            elif version[0] == 1:
+                self._db.execute('ALTER TABLE nodes '
+                                 'ADD COLUMN fingerprint BLOB')
+                self._db.execute('ALTER TABLE nodes '
+                                 'ADD COLUMN nodeinfo_changed_at INTEGER')
+                self._db.execute("UPDATE meta SET value = ? "
+                                 "WHERE key = 'version'",
+                                 (NODESTORE_VERSION,))
+            elif version[0] != NODESTORE_VERSION:
+                raise RuntimeError('nodestore: {0} has version {1}, expected '
+                                   '{2}'.format(filename, version[0],
+                                                NODESTORE_VERSION))
+
+    def load(self):
+        """
+        Return all nodes as a dict mapping node ids to Nodes.
+        """
+        nodes = dict()
+        self._rows = dict()
+        for row in self._db.execute('SELECT node_id, {0} FROM nodes '
+                                    'ORDER BY rowid'.format(
+                                        ', '.join(_COLUMNS))):
+            node_id, row = row[0], tuple(row[1:])
+            nodes[node_id] = _node(row)
+            self._rows[node_id] = row
+
+        return nodes
+
+    def save(self, nodes):
+        """
+        Make the database contain exactly nodes, only writing rows which
+        changed. Returns the number of rows written or deleted.
+        """
+        changed = []
+        added = []
+        for node_id, node in nodes.items():
+            row = _row(node)
+            old = self._rows.get(node_id)
+            if old is None:
+                added.append((node_id,) + row)
+            elif old != row:
+                changed.append(row + (node_id,))
+        removed = [(node_id,) for node_id in self._rows
+                   if node_id not in nodes]
+
+        with self._db:
+            self._db.executemany(
+                'UPDATE nodes SET {0} WHERE node_id = ?'.format(
+                    ', '.join(c + ' = ?' for c in _COLUMNS)), changed)
+            self._db.executemany(
+                'INSERT INTO nodes (node_id, {0}) VALUES (?, {1})'.format(
+                    ', '.join(_COLUMNS), ', '.join('?' * len(_COLUMNS))),
+                added)
+            self._db.executemany('DELETE FROM nodes WHERE node_id = ?',
+                                 removed)
+
+        for row in changed:
+            self._rows[row[-1]] = row[:-1]
+        for row in added:
+            self._rows[row[0]] = row[1:]
+        for node_id, in removed:
+            del self._rows[node_id]
+
+        return len(changed) + len(added) + len(removed)
+
+    def prune(self, nodes, macs, now, days):
+        """
+        Remove the nodes not seen for at least days days from nodes and
+        macs, like nodes.prune_nodes. The database changes with the next
+        save().
+        """
+        cutoff = timestamp(now) - days * 86400
+
+        # nodes stored as stale, and new ones which were never stored
+        candidates = set(node_id for node_id, in self._db.execute(
+            'SELECT node_id FROM nodes WHERE lastseen IS NULL '
+            'OR lastseen <= ?', (isotime(cutoff),)))
+        candidates.update(node_id for node_id in nodes
+                          if node_id not in self._rows)
+
+        for node_id in candidates:
+            node = nodes.get(node_id)
+            # it may have been seen since it was stored
+            if node is None:
+                continue
+            if node.lastseen is None or node.lastseen <= cutoff:
+                del nodes[node_id]
+                macs.remove_node(node_id)
+
+    def close(self):
+        self._db.close()
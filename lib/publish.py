@@ -0,0 +1,282 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# encoding -> file name suffix of the precompressed sidecar
+ENCODINGS = {'gzip': '.gz', 'br': '.br'}
+
+
+class _HashingWriter(object):
+    """
+    File wrapper that hashes everything written to a binary file. Text is
+    encoded as UTF-8.
+    """
+    def __init__(self, f):
+        self._f = f
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.hash.update(data)
+        self.size += len(data)
+        self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+    def entry(self):
+        sha256 = self.hash.hexdigest()
+        return {'sha256': sha256,
+                'size': self.size,
+                'etag': '"{0}"'.format(sha256)}
+
+
+def _compress(source, target, encoding):
+    """
+    Compress the file source to target, returns its manifest entry.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        writer = _HashingWriter(dst)
+        if encoding == 'gzip':
+            with gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=9,
+                               mtime=0) as f:
+                shutil.copyfileobj(src, f)
+        else:
+            writer.write(brotli.compress(src.read()))
+
+    return writer.entry()
+
+
+class Publisher(object):
+    """
+    Publishes the output files of a run as one consistent generation.
+
+    Every run writes into a new directory generations/<n> below dest_dir.
+    Files with the same content as in the previous generation are hard
+    linked to it instead of being written again, and a run that changes
+    nothing does not create a generation at all. Once all files are
+    written, the dest_dir/current symlink is atomically swapped to the new
+    generation. For every published file (or top level directory) there is
+    a dest_dir/<name> -> current/<name> symlink, so the usual paths keep
+    working.
+
+    Next to every file, a precompressed sidecar (name.gz, name.br) is
+    published for each of encodings, to be served by e.g. nginx'
+    gzip_static. The manifest holds SHA-256, size and ETag of every file and
+    sidecar.
+
+    Readers that must not mix files of different generations read
+    manifest.json first and fetch the files from generations/<n>/.
+    """
+    def __init__(self, dest_dir, keep=3, encodings=('gzip',)):
+        if 'br' in encodings and brotli is None:
+            raise RuntimeError('publish: brotli compression requires the '
+                               'brotli module')
+
+        self.dest_dir = dest_dir
+        self.generations_dir = os.path.join(dest_dir, 'generations')
+        self.current = os.path.join(dest_dir, 'current')
+        self.keep = keep
+        self.encodings = encodings
+
+        os.makedirs(self.generations_dir, exist_ok=True)
+        self.manifest = self._read_manifest(self.current)
+        self._path = None
+
+    @staticmethod
+    def _read_manifest(path):
+        try:
+            with open(os.path.join(path, MANIFEST), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'generation': 0, 'files': dict()}
+
+    def begin(self):
+        """
+        Start a new generation.
+        """
+        self._generation = self.manifest['generation'] + 1
+        self._path = os.path.join(self.generations_dir, str(self._generation))
+        self._files = dict()
+
+        # left over by a run that did not finish
+        if os.path.exists(self._path):
+            shutil.rmtree(self._path)
+        os.makedirs(self._path)
+
+    @contextmanager
+    def open(self, name):
+        """
+        Open the file name of the current generation for writing text.
+        """
+        filename = os.path.join(self._path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        with open(filename + '.tmp', 'wb') as f:
+            writer = _HashingWriter(f)
+            yield writer
+
+        entry = writer.entry()
+        entry['encodings'] = dict()
+        self._files[name] = entry
+
+        previous = os.path.join(self.current, name)
+        previous_entry = self.manifest['files'].get(name, {})
+        unchanged = previous_entry.get('sha256') == entry['sha256'] and \
+            os.path.exists(previous)
+
+        if unchanged:
+            os.unlink(filename + '.tmp')
+            self._link(previous, filename)
+        else:
+            os.rename(filename + '.tmp', filename)
+
+        for encoding in self.encodings:
+            suffix = ENCODINGS[encoding]
+            previous_encodings = previous_entry.get('encodings', {})
+            if unchanged and encoding in previous_encodings and \
+                    os.path.exists(previous + suffix):
+                self._link(previous + suffix, filename + suffix)
+                entry['encodings'][encoding] = previous_encodings[encoding]
+            else:
+                entry['encodings'][encoding] = _compress(
+                    filename, filename + suffix, encoding)
+
+    def _unchanged(self, name):
+        """
+        Return the manifest entry of name in the previous generation if the
+        file and its sidecars are still there, None otherwise.
+        """
+        entry = self.manifest['files'].get(name)
+        if entry is None:
+            return None
+
+        previous = os.path.join(self.current, name)
+        encodings = entry.get('encodings', {})
+        if not all(encoding in encodings for encoding in self.encodings):
+            return None
+        paths = [previous] + [previous + ENCODINGS[encoding]
+                              for encoding in self.encodings]
+        if not all(map(os.path.exists, paths)):
+            return None
+
+        return entry
+
+    def _keep(self, name, entry):
+        previous = os.path.join(self.current, name)
+        filename = os.path.join(self._path, name)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self._link(previous, filename)
+        for encoding in self.encodings:
+            suffix = ENCODINGS[encoding]
+            self._link(previous + suffix, filename + suffix)
+        self._files[name] = dict(entry, encodings=dict(
+            (encoding, entry['encodings'][encoding])
+            for encoding in self.encodings))
+
+    def write(self, name, data):
+        """
+        Publish the text data as the file name of the current generation.
+        If it is the same as in the previous generation, it is linked
+        without being written or compressed at all.
+        """
+        data = data.encode('utf-8')
+        entry = self._unchanged(name)
+        if entry is None or \
+                entry.get('sha256') != hashlib.sha256(data).hexdigest():
+            with self.open(name) as f:
+                f.write(data)
+        else:
+            self._keep(name, entry)
+
+    def republish(self, name):
+        """
+        Publish the file name of the previous generation again, without
+        reading it. Returns False if it is not there.
+        """
+        entry = self._unchanged(name)
+        if entry is None:
+            return False
+
+        self._keep(name, entry)
+        return True
+
+    @staticmethod
+    def _link(source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    @staticmethod
+    def _symlink(source, link_name):
+        """
+        Atomically create or replace the symlink link_name.
+        """
+        tmp = link_name + '.tmp'
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(source, tmp)
+        os.replace(tmp, link_name)
+
+    def commit(self):
+        """
+        Publish the current generation. Returns False if nothing changed.
+        """
+        path, self._path = self._path, None
+
+        if self._files == self.manifest['files']:
+            shutil.rmtree(path)
+            return False
+
+        manifest = {'generation': self._generation, 'files': self._files}
+        with open(os.path.join(path, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+        self._symlink(os.path.relpath(path, self.dest_dir), self.current)
+        self.manifest = manifest
+
+        names = set([MANIFEST])
+        for name in self._files:
+            if '/' in name:
+                names.add(name.split('/')[0])
+            else:
+                names.add(name)
+                names.update(name + ENCODINGS[encoding]
+                             for encoding in self.encodings)
+        for name in names:
+            link_name = os.path.join(self.dest_dir, name)
+            # don't replace directories not created by us
+            if os.path.isdir(link_name) and not os.path.islink(link_name):
+                continue
+            self._symlink(os.path.join('current', name), link_name)
+
+        # remove links to files no longer published
+        for name in set(os.listdir(self.dest_dir)) - names:
+            link_name = os.path.join(self.dest_dir, name)
+            if os.path.islink(link_name) and \
+                    os.readlink(link_name).startswith('current/'):
+                os.unlink(link_name)
+
+        self._prune()
+        return True
+
+    def _prune(self):
+        generations = sorted(int(name)
+                             for name in os.listdir(self.generations_dir)
+                             if name.isdigit())
+        for generation in generations[:-self.keep]:
+            shutil.rmtree(os.path.join(self.generations_dir,
+                                       str(generation)))
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 
+from lib.ArrayRRD import ArrayGlobalRRD, ArrayNodeRRD
 from lib.GlobalRRD import GlobalRRD
 from lib.NodeRRD import NodeRRD
+from lib.RRD import RRDOutdatedException
+from lib.rrdexport import export_rrd
+from lib.rrdschedule import RenderScheduler
+from lib.rrdtool import RRDTool
+from lib.schemacache import SchemaCache
 
 
 class RRD(object):
@@ -11,13 +18,40 @@ class RRD(object):
                  database_directory,
                  image_path,
                  display_time_global="7d",
-                 display_time_node="1d"):
+                 display_time_node="1d",
+                 rrdtool=None,
+                 jobs=1,
+                 refresh_intervals=None,
+                 image_format='png',
+                 engine='rrdtool'):
+        """
+        Graphs are rendered by up to `jobs` threads, which only makes sense
+        with an rrdtool backend running that many processes. See
+        RenderScheduler for refresh_intervals.
+
+        With image_format 'json', the series of every RRA are exported as
+        JSON for the frontend to draw instead of rendering PNGs.
+
+        With engine 'array', the databases are ArrayRRD files written without
+        rrdtool, which requires image_format 'json'.
+        """
+        if engine == 'array':
+            self.globalClass, self.nodeClass = ArrayGlobalRRD, ArrayNodeRRD
+        else:
+            self.globalClass, self.nodeClass = GlobalRRD, NodeRRD
 
         self.dbPath = database_directory
-        self.globalDb = GlobalRRD(self.dbPath)
+        self.rrdtool = rrdtool or RRDTool()
+        self.schemaCache = SchemaCache(
+            os.path.join(self.dbPath, 'schema-cache.json'))
+        self.globalDb = self.globalClass(self.dbPath, self.rrdtool,
+                                         self.schemaCache)
         self.imagePath = image_path
         self.displayTimeGlobal = display_time_global
         self.displayTimeNode = display_time_node
+        self.jobs = jobs
+        self.imageFormat = image_format
+        self.scheduler = RenderScheduler(refresh_intervals=refresh_intervals)
 
         self.currentTimeInt = (int(time.time()) / 60) * 60
         self.currentTime = str(self.currentTimeInt)
@@ -28,19 +62,83 @@ class RRD(object):
             os.mkdir(self.imagePath)
 
     def update_database(self, nodes):
+        """
+        Update the RRDs of all online nodes. RRDs that need an upgrade are
+        left to migrate.py and skipped, returns their number.
+        """
         online_nodes = dict(filter(
-            lambda d: d[1]['flags']['online'], nodes.items()))
+            lambda d: d[1].online, nodes.items()))
         client_count = sum(map(
-            lambda d: d['statistics']['clients'], online_nodes.values()))
+            lambda d: d.statistics['clients'], online_nodes.values()))
 
         self.globalDb.update(len(online_nodes), client_count)
+        self.scheduler.touch(self.globalDb.filename)
+        outdated = 0
         for node_id, node in online_nodes.items():
-            rrd = NodeRRD(os.path.join(self.dbPath, node_id + '.rrd'), node)
+            try:
+                rrd = self.nodeClass(
+                    os.path.join(self.dbPath,
+                                 node_id + '.' + self.nodeClass.extension),
+                    node, self.rrdtool, self.schemaCache, upgrade=False)
+            except RRDOutdatedException:
+                outdated += 1
+                continue
             rrd.update()
+            self.scheduler.touch(rrd.filename)
+
+        # send what the backend queued
+        self.rrdtool.flush()
+        self.schemaCache.save()
+
+        return outdated
+
+    def render_global(self, image):
+        self.globalDb.graph(image, self.displayTimeGlobal)
+        return 1
+
+    def open_node(self, filename):
+        """
+        Return the RRD of filename, None if it needs an upgrade.
+        """
+        try:
+            return self.nodeClass(filename, rrdtool=self.rrdtool,
+                                  schema_cache=self.schemaCache,
+                                  upgrade=False)
+        except RRDOutdatedException:
+            return None
+
+    def render_node(self, filename):
+        rrd = self.open_node(filename)
+        if rrd is None:
+            return 0
+        rrd.graph(self.imagePath, self.displayTimeNode)
+        return 1
+
+    def export(self, rrd, basename):
+        return export_rrd(rrd, self.imagePath, basename,
+                          self.scheduler.last_update(rrd.filename),
+                          int(time.time()))
+
+    def export_node(self, filename):
+        rrd = self.open_node(filename)
+        if rrd is None:
+            return 0
+        return self.export(rrd, rrd.imagename.rsplit('.', 1)[0])
 
     def update_images(self):
-        self.globalDb.graph(os.path.join(self.imagePath, "globalGraph.png"),
-                            self.displayTimeGlobal)
+        """
+        Render the graphs the scheduler considers due, or export the series
+        with new rows. Returns the number of files written.
+        """
+        jobs = []
+        export = self.imageFormat == 'json'
+
+        image = os.path.join(self.imagePath, "globalGraph.png")
+        if export:
+            jobs.append((self.export, self.globalDb, 'global'))
+        elif self.scheduler.due(self.globalDb.filename, image,
+                                self.displayTimeGlobal):
+            jobs.append((self.render_global, image))
 
         nodedb_files = os.listdir(self.dbPath)
 
@@ -49,6 +147,23 @@ class RRD(object):
                 continue
 
             node_name = os.path.basename(file_name).split('.')
-            if node_name[1] == 'rrd' and not node_name[0] == "nodes":
-                rrd = NodeRRD(os.path.join(self.dbPath, file_name))
-                rrd.graph(self.imagePath, self.displayTimeNode)
+            if node_name[1] == self.nodeClass.extension and \
+                    not node_name[0] == "nodes":
+                filename = os.path.join(self.dbPath, file_name)
+                image = os.path.join(self.imagePath,
+                                     self.nodeClass.image_name(filename))
+                if export:
+                    jobs.append((self.export_node, filename))
+                elif self.scheduler.due(filename, image,
+                                        self.displayTimeNode):
+                    jobs.append((self.render_node, filename))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [executor.submit(*job) for job in jobs]
+            written = sum(future.result() for future in futures)
+
+        self.schemaCache.save()
+        return written
+
+    def close(self):
+        self.rrdtool.close()
@@ -0,0 +1,116 @@
+import json
+import os
+
+SERIES_VERSION = 1
+
+
+def _compact(value):
+    # four significant digits are plenty for a chart
+    if value is None:
+        return None
+    value = float('{0:.4g}'.format(value))
+    return int(value) if value.is_integer() else value
+
+
+def _load(filename):
+    try:
+        with open(filename, 'r') as f:
+            series = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if series.get('version') != SERIES_VERSION:
+        return None
+    return series
+
+
+def _rows(series):
+    """
+    Return a dict mapping the timestamps of series to their values.
+    """
+    columns = [series['values'][name] for name in series['ds']]
+    return dict((series['start'] + i * series['step'], list(values))
+                for i, values in enumerate(zip(*columns)))
+
+
+def update_series(rrd, filename, resolution, rows, last_update, now):
+    """
+    Update the series of rrd with resolution seconds per row in filename.
+
+    The file holds the last rows rows of the series as
+    {'version', 'start', 'step', 'ds', 'values': {ds: [...]}}, the timestamp
+    of the i-th value being start + i * step. Only rows newer than those in
+    the file are fetched, and nothing is fetched if rrd got no data since
+    the file was written (last_update) or there can't be a new row yet.
+
+    Returns whether filename was written.
+    """
+    try:
+        if last_update <= os.stat(filename).st_mtime:
+            return False
+    except OSError:
+        pass
+
+    series = _load(filename)
+    if series is not None and series['step'] == resolution:
+        count = len(series['values'][series['ds'][0]])
+        end = series['start'] + (count - 1) * resolution
+        if now < end + resolution:
+            return False
+        # the last row may have been incomplete
+        start = end - resolution
+        known = _rows(series)
+    else:
+        start = now - rows * resolution
+        known = dict()
+
+    ds_names, fetched = rrd.fetch('AVERAGE', resolution, start, now)
+    if series is not None and series['ds'] != ds_names:
+        known = dict()
+
+    # rows ending in the future are incomplete, fetch them next time
+    known.update((timestamp, [_compact(value) for value in values])
+                 for timestamp, values in fetched if timestamp <= now)
+    if not known:
+        return False
+
+    # rrdtool may pick an RRA of another resolution
+    if len(fetched) > 1:
+        resolution = fetched[1][0] - fetched[0][0]
+
+    last = max(known)
+    first = max(min(known), last - (rows - 1) * resolution)
+    empty = [None] * len(ds_names)
+    timestamps = range(first, last + 1, resolution)
+
+    series = {'version': SERIES_VERSION,
+              'start': first,
+              'step': resolution,
+              'ds': ds_names,
+              'values': dict((name, [known.get(t, empty)[i]
+                                     for t in timestamps])
+                             for i, name in enumerate(ds_names))}
+
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(series, f, separators=(',', ':'))
+    os.rename(filename + '.tmp', filename)
+
+    return True
+
+
+def export_rrd(rrd, directory, basename, last_update, now):
+    """
+    Export every RRA of rrd to directory/basename.<resolution>.json, returns
+    the number of files written.
+    """
+    written = 0
+    for rra in rrd.rra_list:
+        # RRA(cf, xff, steps per row, rows)
+        _, steps, rows = rra.args
+        resolution = rrd.step * steps
+        filename = os.path.join(directory, '{0}.{1}.json'.format(basename,
+                                                                 resolution))
+        if update_series(rrd, filename, resolution, rows, last_update, now):
+            written += 1
+
+    return written
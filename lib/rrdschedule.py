@@ -0,0 +1,80 @@
+import os
+import re
+import time
+
+# seconds per unit of rrdtool's time offsets
+_UNITS = {'s': 1, 'sec': 1, 'min': 60, 'h': 3600, 'd': 86400, 'w': 604800,
+          'm': 2592000, 'mon': 2592000, 'y': 31536000}
+
+
+def timeframe_seconds(timeframe):
+    """
+    Return the length of a timeframe like '1d' or '12h' in seconds.
+    """
+    match = re.match(r'^(\d+)\s*([a-z]+)$', timeframe)
+    if not match or match.group(2) not in _UNITS:
+        raise ValueError('invalid timeframe {0!r}'.format(timeframe))
+
+    return int(match.group(1)) * _UNITS[match.group(2)]
+
+
+class RenderScheduler(object):
+    """
+    Decides which RRD graphs need to be rendered again.
+
+    A graph is due if its image is missing, or if at least the refresh
+    interval of its timeframe has passed since it was rendered and either
+    the RRD got new data or the data was still visible in the window last
+    time, so moving the window changes the graph. By default the refresh
+    interval is the time one pixel of a graph width pixels wide covers.
+
+    Graphs of RRDs without data in the window are not rendered again until
+    they get new data, like those of nodes that have been offline for long.
+    """
+    def __init__(self, width=800, refresh_intervals=None):
+        self.width = width
+        self.refresh_intervals = refresh_intervals or dict()
+        # RRD filename -> time of the last update
+        self._updated = dict()
+
+    def refresh_interval(self, timeframe):
+        try:
+            return self.refresh_intervals[timeframe]
+        except KeyError:
+            return timeframe_seconds(timeframe) / self.width
+
+    def touch(self, filename, now=None):
+        """
+        Record that filename got new data.
+        """
+        self._updated[filename] = now or time.time()
+
+    def last_update(self, filename):
+        """
+        Return when filename got new data last. Updates kept by rrdcached
+        don't change the mtime, so those recorded with touch() count, too.
+        """
+        try:
+            mtime = os.stat(filename).st_mtime
+        except OSError:
+            mtime = 0
+
+        return max(mtime, self._updated.get(filename, 0))
+
+    def due(self, filename, image, timeframe, now=None):
+        """
+        Return whether the graph of filename over timeframe needs to be
+        rendered to image.
+        """
+        now = now or time.time()
+        try:
+            rendered = os.stat(image).st_mtime
+        except OSError:
+            return True
+
+        if now - rendered < self.refresh_interval(timeframe):
+            return False
+
+        # new data, or old data the moved window still shows
+        return self.last_update(filename) > \
+            rendered - timeframe_seconds(timeframe)
@@ -0,0 +1,349 @@
+"""
+Ways of running rrdtool commands for lib.RRD.
+
+RRDTool starts a process for every command. RRDToolPipe keeps `rrdtool -`
+processes running and RRDCached hands updates to rrdcached, both send
+updates in batches.
+"""
+import os
+import socket
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+
+def _env():
+    # rrdtool info prints numbers in the current locale otherwise
+    env = os.environ.copy()
+    env['LC_ALL'] = 'C'
+    return env
+
+
+def _quote(arg):
+    """
+    Quote arg for rrdtool's remote control mode, which splits command lines
+    at spaces and only knows single and double quotes, no escapes.
+    """
+    arg = str(arg)
+    if '\n' in arg or ("'" in arg and '"' in arg):
+        raise ValueError('rrdtool: cannot pass {0!r} through a pipe'.format(
+            arg))
+    if arg and not any(c in arg for c in ' \'"'):
+        return arg
+
+    return '"{0}"'.format(arg) if "'" in arg else "'{0}'".format(arg)
+
+
+class RRDTool(object):
+    """
+    Runs every rrdtool command as a process of its own.
+    """
+    # whether update() accepts a template
+    supports_template = True
+
+    def run(self, cmd, *args):
+        """
+        Run rrdtool cmd with args and return its output.
+        """
+        pargs = ['rrdtool', cmd]
+        pargs.extend(map(str, args))
+        return subprocess.check_output(pargs, env=_env()).decode('utf-8')
+
+    def update(self, filename, values, template=None):
+        """
+        Update filename with values, e.g. 'N:1:2'. Backends may defer the
+        update until flush().
+        """
+        args = ['--template', template] if template else []
+        self.run('update', filename, *(args + [values]))
+
+    def flush(self, filename=None):
+        """
+        Send all deferred updates. If filename is given, make sure its
+        updates have been written to disk.
+        """
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class _RemoteControl(object):
+    """
+    A `rrdtool -` process, running the commands written to its stdin.
+    """
+    def __init__(self):
+        self._proc = subprocess.Popen(['rrdtool', '-'],
+                                      stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      env=_env())
+
+    @property
+    def alive(self):
+        return self._proc.poll() is None
+
+    def _response(self):
+        """
+        Return (output, error) of a command, error is None on success.
+        """
+        output = []
+        for line in self._proc.stdout:
+            line = line.decode('utf-8', 'replace')
+            if line.startswith('OK '):
+                return ''.join(output), None
+            if line.startswith('ERROR:'):
+                return ''.join(output), line[6:].strip()
+            output.append(line)
+
+        raise RuntimeError('rrdtool: remote control process exited')
+
+    def execute(self, commands, batch_size):
+        """
+        Run commands, a list of argument lists, and return their
+        (output, error) tuples.
+        """
+        results = []
+        try:
+            # rrdtool blocks once we don't read its answers, so don't send
+            # more than it can buffer
+            for i in range(0, len(commands), batch_size):
+                chunk = commands[i:i + batch_size]
+                self._proc.stdin.write(b''.join(
+                    ' '.join(map(_quote, command)).encode('utf-8') + b'\n'
+                    for command in chunk))
+                self._proc.stdin.flush()
+                results.extend(self._response() for _ in chunk)
+        except (IOError, RuntimeError):
+            # answers are out of sync now
+            self.kill()
+            raise
+
+        return results
+
+    def kill(self):
+        self._proc.kill()
+        self._proc.wait()
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.wait()
+
+
+class RRDToolPipe(RRDTool):
+    """
+    Sends all commands to long-running `rrdtool -` processes.
+
+    Updates are queued and written batch_size at a time, without waiting for
+    the answer to each of them in between. The queue is sent before any
+    other command runs, when it is full, or by flush().
+
+    Commands run from several threads at once use up to `processes`
+    processes, which are started on demand and kept for later commands.
+    """
+    def __init__(self, batch_size=500, processes=1):
+        self.batch_size = batch_size
+        self._idle = []
+        # guards _idle, which render threads share
+        self._idle_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(processes)
+        self._queue = []
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def _process(self):
+        with self._slots:
+            proc = None
+            with self._idle_lock:
+                while self._idle and proc is None:
+                    proc = self._idle.pop()
+                    if not proc.alive:
+                        proc = None
+            if proc is None:
+                proc = _RemoteControl()
+
+            yield proc
+
+            if proc.alive:
+                with self._idle_lock:
+                    self._idle.append(proc)
+
+    def run(self, cmd, *args):
+        self.flush()
+        with self._process() as proc:
+            output, error = proc.execute([[cmd] + list(args)],
+                                         self.batch_size)[0]
+
+        if error is not None:
+            raise RuntimeError('rrdtool: {0} failed: {1}'.format(cmd, error))
+        return output
+
+    def update(self, filename, values, template=None):
+        command = ['update', filename]
+        if template:
+            command.extend(['--template', template])
+        command.append(values)
+
+        with self._lock:
+            self._queue.append(command)
+            if len(self._queue) >= self.batch_size:
+                self.flush()
+
+    def flush(self, filename=None):
+        # keeps updates in order, even if several threads flush
+        with self._lock:
+            queue, self._queue = self._queue, []
+            if not queue:
+                return
+            with self._process() as proc:
+                errors = [error for _, error
+                          in proc.execute(queue, self.batch_size)
+                          if error is not None]
+
+        if errors:
+            raise RuntimeError('rrdtool: {0} of {1} updates failed: {2}'.
+                               format(len(errors), len(queue), errors[0]))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._idle_lock:
+                idle, self._idle = self._idle, []
+            for proc in idle:
+                proc.close()
+
+
+class RRDCached(RRDTool):
+    """
+    Hands updates to rrdcached listening on the unix socket address.
+
+    Updates are queued and sent batch_size at a time with rrdcached's BATCH
+    command. rrdcached keeps them in memory and writes them to disk at its
+    own pace, so only flush(filename) or commands reading an RRD (like graph)
+    make it write them. All other commands go through an RRDToolPipe with up
+    to `processes` processes.
+
+    rrdcached knows no templates, so values must be in DS order.
+    """
+    supports_template = False
+
+    # commands which have to see all updates, they are run with --daemon
+    _reading = ('graph', 'graphv', 'fetch', 'xport', 'dump', 'lastupdate')
+
+    def __init__(self, address, batch_size=1000, processes=1):
+        self.address = address
+        self.batch_size = batch_size
+        self.pipe = RRDToolPipe(processes=processes)
+        self._stream = None
+        self._queue = []
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        if self._stream is None:
+            path = self.address
+            if path.startswith('unix:'):
+                path = path[len('unix:'):]
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+            except socket.error as e:
+                sock.close()
+                raise RuntimeError('rrdcached: cannot connect to {0}: {1}'.
+                                   format(path, e))
+            self._stream = sock.makefile('rwb')
+            sock.close()
+
+    def _disconnect(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+    def _send(self, lines):
+        self._stream.write(b''.join(line.encode('utf-8') + b'\n'
+                                    for line in lines))
+        self._stream.flush()
+
+    def _response(self):
+        """
+        Read an answer and return (status, message, lines). A positive
+        status is the number of lines following the status line.
+        """
+        header = self._stream.readline().decode('utf-8')
+        if not header.endswith('\n'):
+            raise RuntimeError('rrdcached: connection closed')
+
+        status, _, message = header.rstrip('\n').partition(' ')
+        status = int(status)
+        lines = [self._stream.readline().decode('utf-8').rstrip('\n')
+                 for _ in range(max(status, 0))]
+
+        if status < 0:
+            raise RuntimeError('rrdcached: {0}'.format(message))
+        return status, message, lines
+
+    def _command(self, *lines):
+        """
+        Send lines and return the answer to the last of them.
+        """
+        self._connect()
+        try:
+            self._send(lines)
+            return self._response()
+        except (IOError, ValueError):
+            self._disconnect()
+            raise
+
+    @staticmethod
+    def _filename(filename):
+        filename = os.path.abspath(filename)
+        if any(c in filename for c in ' \n'):
+            raise ValueError('rrdcached: cannot pass {0!r}'.format(filename))
+        return filename
+
+    def run(self, cmd, *args):
+        self.flush()
+        if cmd in self._reading:
+            args = ('--daemon', self.address) + args
+
+        return self.pipe.run(cmd, *args)
+
+    def update(self, filename, values, template=None):
+        if template:
+            raise ValueError('rrdcached: updates with template are not '
+                             'supported')
+
+        # rrdcached would take N as the time the update is written
+        if values.startswith('N:'):
+            values = '{0}:{1}'.format(int(time.time()), values[2:])
+
+        with self._lock:
+            self._queue.append('UPDATE {0} {1}'.format(
+                self._filename(filename), values))
+            if len(self._queue) >= self.batch_size:
+                self.flush()
+
+    def flush(self, filename=None):
+        errors = []
+        with self._lock:
+            queue, self._queue = self._queue, []
+            for i in range(0, len(queue), self.batch_size):
+                chunk = queue[i:i + self.batch_size]
+                self._command('BATCH')
+                # errors are reported as "<command number> <message>"
+                errors.extend(self._command(*(chunk + ['.']))[2])
+
+            if filename is not None:
+                self._command('FLUSH {0}'.format(self._filename(filename)))
+
+        if errors:
+            raise RuntimeError('rrdcached: {0} of {1} updates failed: {2}'.
+                               format(len(errors), len(queue), errors[0]))
+
+    def close(self):
+        with self._lock:
+            try:
+                self.flush()
+            finally:
+                self._disconnect()
+                self.pipe.close()
@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import threading
+
+SCHEMA_CACHE_VERSION = 1
+
+
+def ds_list_hash(ds_list):
+    data = '\n'.join(map(str, ds_list)).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
+
+
+class SchemaCache(object):
+    """
+    Remembers which RRD files have been checked against which DS list, so
+    they don't need to be checked with `rrdtool info` again on every run.
+
+    A file is identified by path, inode and size. RRD files have a fixed
+    size and are replaced by a new file when they are created or upgraded,
+    so inode and size change whenever the definition does. The mtime is not
+    part of the key, as every update changes it.
+
+    Next to the key, the names of the DS in the file are stored in their
+    order, for updates that can't use a template.
+
+    It may be used from several threads at once.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._dirty = False
+        self._lock = threading.Lock()
+
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            data = {}
+
+        if data.get('version') == SCHEMA_CACHE_VERSION:
+            self._files = data['files']
+        else:
+            self._files = dict()
+
+    @staticmethod
+    def _key(filename, ds_list):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+
+        return [stat.st_ino, stat.st_size, ds_list_hash(ds_list)]
+
+    def get(self, filename, ds_list):
+        """
+        Return the DS names of filename if it has been verified to contain
+        ds_list, None otherwise.
+        """
+        entry = self._files.get(filename)
+        if entry is None or entry['key'] != self._key(filename, ds_list):
+            return None
+
+        return entry['ds']
+
+    def add(self, filename, ds_list, ds_names):
+        """
+        Record that filename contains ds_list, its DS being ds_names.
+        """
+        key = self._key(filename, ds_list)
+        if key is not None:
+            with self._lock:
+                self._files[filename] = {'key': key, 'ds': ds_names}
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+
+            with open(self.filename + '.tmp', 'w') as f:
+                json.dump({'version': SCHEMA_CACHE_VERSION,
+                           'files': self._files}, f)
+            os.rename(self.filename + '.tmp', self.filename)
+            self._dirty = False
@@ -0,0 +1,55 @@
+import json
+import zlib
+
+SHARDS_VERSION = 1
+
+
+def shard_of(node_id, shards):
+    return zlib.crc32(node_id.encode('utf-8')) % shards
+
+
+def export_index_node(node_id, node, shards):
+    node_out = {'id': node_id,
+                'name': node.nodeinfo.get('hostname'),
+                'online': node.online,
+                'clients': node.statistics.get('clients', 0),
+                'shard': shard_of(node_id, shards)}
+
+    location = node.nodeinfo.get('location')
+    if location is not None:
+        node_out['position'] = {'lat': location.get('latitude'),
+                                'long': location.get('longitude')}
+
+    return node_out
+
+
+def export_index(now, nodedb, shards):
+    """
+    Return the index of the sharded output, holding what the map overview
+    needs of every node and the shard with all of its data.
+    """
+    index = [export_index_node(node_id, node, shards)
+             for node_id, node in nodedb['nodes'].items()]
+
+    return {'version': SHARDS_VERSION,
+            'timestamp': now.isoformat(),
+            'shards': shards,
+            'nodes': index}
+
+
+def export_shards(nodedb, shards):
+    """
+    Yield (name, JSON text) of every shard, shards/<n>.json holding the
+    nodes of shard n as they are in nodes.json.
+    """
+    buckets = [[] for _ in range(shards)]
+    for node_id in sorted(nodedb['nodes']):
+        buckets[shard_of(node_id, shards)].append(node_id)
+
+    for shard, node_ids in enumerate(buckets):
+        nodes = ', '.join('{0}: {1}'.format(
+            json.dumps(node_id), nodedb['nodes'][node_id].export_json())
+            for node_id in node_ids)
+        yield ('shards/{0}.json'.format(shard),
+               '{{"version": {0}, "nodes": {{{1}}}}}'.format(
+                   SHARDS_VERSION, nodes))
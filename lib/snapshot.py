@@ -0,0 +1,43 @@
+import hashlib
+import os
+import pickle
+
+SNAPSHOT_VERSION = 3
+
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def load_snapshot(filename, nodes_fn):
+    """
+    Return the nodedb pickled to filename, if it was taken of nodes_fn as
+    it is now. Returns None if the snapshot is missing or stale.
+
+    Hashing nodes.json is much cheaper than parsing it.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            version, sha256 = pickle.load(f)
+            if version != SNAPSHOT_VERSION or sha256 != file_hash(nodes_fn):
+                return None
+            return pickle.load(f)
+    except (IOError, EOFError, TypeError, ValueError,
+            pickle.UnpicklingError):
+        return None
+
+
+def save_snapshot(filename, nodedb, sha256):
+    """
+    Pickle nodedb to filename, sha256 being the hash of the nodes.json it
+    was written to.
+    """
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump((SNAPSHOT_VERSION, sha256), f)
+        pickle.dump(nodedb, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(filename + '.tmp', filename)
@@ -0,0 +1,158 @@
+import json
+import math
+
+TILES_VERSION = 1
+
+# tiles above the deepest zoom level summarize their nodes in clusters, one
+# for each occupied tile this many levels deeper
+CLUSTER_LEVELS = 3
+
+# the web mercator projection ends here
+_MAX_LATITUDE = 85.0511287798
+
+
+def tile_of(latitude, longitude, zoom):
+    """
+    Return (x, y) of the slippy map tile containing the position at zoom.
+    """
+    n = 1 << zoom
+    latitude = math.radians(max(min(latitude, _MAX_LATITUDE), -_MAX_LATITUDE))
+    mercator = math.log(math.tan(latitude) + 1.0 / math.cos(latitude))
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - mercator / math.pi) / 2.0 * n)
+
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def node_position(node):
+    """
+    Return (latitude, longitude) of node, None if it has no valid location.
+    """
+    try:
+        location = node.nodeinfo['location']
+        position = (float(location['latitude']),
+                    float(location['longitude']))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    if not all(map(math.isfinite, position)) or \
+            not -90 <= position[0] <= 90 or not -180 <= position[1] <= 180:
+        return None
+    return position
+
+
+def _summary(nodes, node_ids):
+    return {'nodes': len(node_ids),
+            'online': sum(1 for node_id in node_ids
+                          if nodes[node_id].online),
+            'clients': sum(nodes[node_id].statistics.get('clients', 0)
+                           for node_id in node_ids)}
+
+
+class TileIndex(object):
+    """
+    Quadtree of the node locations, as slippy map tiles of zoom levels 0 to
+    max_zoom.
+
+    update() only looks at the location of new nodes and of nodes whose
+    nodeinfo_changed is set, so the index is kept up to date incrementally
+    in daemon mode.
+    """
+    def __init__(self, max_zoom):
+        self.max_zoom = max_zoom
+        # node id -> (position, tile at max_zoom) of last update
+        self._nodes = dict()
+        # zoom -> (x, y) -> set of node ids
+        self._tiles = [dict() for _ in range(max_zoom + 1)]
+
+    def _tile(self, tile, zoom):
+        shift = self.max_zoom - zoom
+        return tile[0] >> shift, tile[1] >> shift
+
+    def _add(self, node_id, tile):
+        for zoom, tiles in enumerate(self._tiles):
+            tiles.setdefault(self._tile(tile, zoom), set()).add(node_id)
+
+    def _remove(self, node_id, tile):
+        for zoom, tiles in enumerate(self._tiles):
+            key = self._tile(tile, zoom)
+            tiles[key].discard(node_id)
+            if not tiles[key]:
+                del tiles[key]
+
+    def update(self, nodes):
+        for node_id in list(self._nodes):
+            if node_id not in nodes:
+                tile = self._nodes.pop(node_id)[1]
+                if tile is not None:
+                    self._remove(node_id, tile)
+
+        for node_id, node in nodes.items():
+            old = self._nodes.get(node_id)
+            if old is not None and not node.nodeinfo_changed:
+                continue
+
+            position = node_position(node)
+            if old is not None and old[0] == position:
+                continue
+
+            tile = None
+            if position is not None:
+                tile = tile_of(position[0], position[1], self.max_zoom)
+            if old is not None and old[1] is not None:
+                self._remove(node_id, old[1])
+            if tile is not None:
+                self._add(node_id, tile)
+            self._nodes[node_id] = (position, tile)
+
+    def _node(self, node_id, node):
+        latitude, longitude = self._nodes[node_id][0]
+        return {'id': node_id,
+                'name': node.nodeinfo.get('hostname'),
+                'position': {'lat': latitude, 'long': longitude},
+                'online': node.online,
+                'clients': node.statistics.get('clients', 0)}
+
+    def _clusters(self, nodes, node_ids, zoom):
+        cells = dict()
+        for node_id in node_ids:
+            cell = self._tile(self._nodes[node_id][1], zoom)
+            cells.setdefault(cell, []).append(node_id)
+
+        clusters = []
+        for cell in sorted(cells):
+            cell_ids = cells[cell]
+            positions = [self._nodes[node_id][0] for node_id in cell_ids]
+            cluster = {'position': {
+                'lat': sum(p[0] for p in positions) / len(positions),
+                'long': sum(p[1] for p in positions) / len(positions)}}
+            cluster.update(_summary(nodes, cell_ids))
+            clusters.append(cluster)
+
+        return clusters
+
+    def export(self, nodes, now):
+        """
+        Yield (name, JSON text) of tiles/meta.json and the file
+        tiles/<zoom>/<x>/<y>.json of every tile holding nodes.
+        """
+        yield 'tiles/meta.json', json.dumps({'version': TILES_VERSION,
+                                             'timestamp': now.isoformat(),
+                                             'max_zoom': self.max_zoom})
+
+        for zoom, tiles in enumerate(self._tiles):
+            for (x, y), node_ids in sorted(tiles.items()):
+                tile = {'version': TILES_VERSION,
+                        'zoom': zoom, 'x': x, 'y': y}
+                node_ids = sorted(node_ids)
+                if zoom == self.max_zoom:
+                    tile['nodes'] = [self._node(node_id, nodes[node_id])
+                                     for node_id in node_ids]
+                else:
+                    tile.update(_summary(nodes, node_ids))
+                    tile['clusters'] = self._clusters(
+                        nodes, node_ids,
+                        min(zoom + CLUSTER_LEVELS, self.max_zoom))
+
+                yield ('tiles/{0}/{1}/{2}.json'.format(zoom, x, y),
+                       json.dumps(tile))
@@ -0,0 +1,59 @@
+from collections import Counter, defaultdict
+from itertools import chain
+
+
+class VisData(object):
+    """
+    batadv-vis records of one mesh, sorted by kind in a single pass:
+
+    - primaries: list of primary interface MACs
+    - secondaries: dict mapping secondary interface MACs to their primary
+    - edges: list of (router, neighbor, tq) tuples
+    - clients: Counter of TT entries per router MAC
+    - client_macs: set of MACs announced in TT entries
+
+    Records can be added one at a time, so a stream of records never has to
+    be held in memory.
+    """
+    def __init__(self, records=()):
+        self.primaries = []
+        self.secondaries = dict()
+        self.edges = []
+        self.clients = Counter()
+        self.client_macs = set()
+
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        if 'primary' in record:
+            self.primaries.append(record['primary'])
+        elif 'secondary' in record:
+            self.secondaries[record['secondary']] = record['of']
+        elif 'neighbor' in record:
+            self.edges.append((record['router'], record['neighbor'],
+                               float(record['label'])))
+        elif 'gateway' in record:
+            # This matches clients' MACs.
+            # On pre-Gluon nodes the primary MAC will be one of it.
+            self.client_macs.add(record['gateway'])
+            if record.get('label', None) == 'TT':
+                self.clients[record['router']] += 1
+
+    def mesh_interfaces(self):
+        """
+        Return a dict mapping each primary MAC with secondary interfaces to
+        the set of all its interface MACs.
+        """
+        mesh_ifs = defaultdict(set)
+        for secondary, primary in self.secondaries.items():
+            mesh_ifs[primary].add(primary)
+            mesh_ifs[primary].add(secondary)
+
+        return mesh_ifs
+
+    def online_macs(self):
+        """
+        Return all MACs the vis data proves to be online.
+        """
+        return set(chain(self.primaries, self.secondaries, self.client_macs))
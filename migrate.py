@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+migrate.py - upgrade the node RRDs of ffmap-backend
+https://github.com/ffnord/ffmap-backend
+
+backend.py skips node RRDs lacking data sources of NodeRRD.ds_list instead
+of upgrading them while it runs. This upgrades them with several workers,
+recording its progress in a checkpoint file, so an interrupted migration
+continues where it stopped when run again.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from lib.ArrayRRD import ArrayGlobalRRD, ArrayNodeRRD
+from lib.GlobalRRD import GlobalRRD
+from lib.NodeRRD import NodeRRD
+from lib.rrdtool import RRDCached, RRDToolPipe
+from lib.schemacache import SchemaCache, ds_list_hash
+
+CHECKPOINT_VERSION = 1
+
+log = logging.getLogger('ffmap-backend')
+
+
+def load_checkpoint(filename, ds_hash):
+    """
+    Return the set of files a previous migration to the DS list hashed to
+    ds_hash has finished.
+    """
+    try:
+        with open(filename, 'r') as f:
+            checkpoint = json.load(f)
+    except (IOError, ValueError):
+        return set()
+
+    if checkpoint.get('version') != CHECKPOINT_VERSION or \
+            checkpoint.get('ds') != ds_hash:
+        return set()
+    return set(checkpoint['done'])
+
+
+def save_checkpoint(filename, ds_hash, done, failed):
+    with open(filename + '.tmp', 'w') as f:
+        json.dump({'version': CHECKPOINT_VERSION,
+                   'ds': ds_hash,
+                   'done': sorted(done),
+                   'failed': sorted(failed)}, f)
+    os.rename(filename + '.tmp', filename)
+
+
+def migrate(directory, node_class, rrdtool, schema_cache, workers=1,
+            checkpoint=None, checkpoint_interval=100):
+    """
+    Upgrade all node RRDs of node_class in directory, up to workers at a
+    time. Returns the number of files which could not be upgraded.
+    """
+    ds_hash = ds_list_hash(node_class.ds_list)
+    done = load_checkpoint(checkpoint, ds_hash) if checkpoint else set()
+    if done:
+        log.info('resuming, %d files done before', len(done))
+
+    extension = '.' + node_class.extension
+    pending = sorted(name for name in os.listdir(directory)
+                     if name.endswith(extension) and name not in done)
+    # the global RRD is upgraded right away
+    if 'nodes' + extension in pending:
+        pending.remove('nodes' + extension)
+    failed = set()
+
+    def upgrade(name):
+        # opening a node RRD upgrades it if needed
+        node_class(os.path.join(directory, name), rrdtool=rrdtool,
+                   schema_cache=schema_cache)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(upgrade, name), name)
+                       for name in pending)
+        for i, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                log.error('%s: %s', name, e)
+                failed.add(name)
+            else:
+                done.add(name)
+
+            if checkpoint and i % checkpoint_interval == 0:
+                save_checkpoint(checkpoint, ds_hash, done, failed)
+                schema_cache.save()
+                log.info('%d of %d files checked', i, len(pending))
+
+    if checkpoint:
+        save_checkpoint(checkpoint, ds_hash, done, failed)
+    schema_cache.save()
+    log.info('checked %d files in %.1fs, %d failed', len(pending),
+             time.time() - started, len(failed))
+    return len(failed)
+
+
+def main(params):
+    if params['rrd_engine'] == 'array':
+        global_class, node_class = ArrayGlobalRRD, ArrayNodeRRD
+    else:
+        global_class, node_class = GlobalRRD, NodeRRD
+
+    if params['rrdcached']:
+        rrdtool = RRDCached(params['rrdcached'], processes=params['workers'])
+    else:
+        rrdtool = RRDToolPipe(processes=params['workers'])
+
+    directory = params['nodedb']
+    checkpoint = params['checkpoint'] or \
+        os.path.join(directory, 'migrate-checkpoint.json')
+    schema_cache = SchemaCache(os.path.join(directory, 'schema-cache.json'))
+
+    try:
+        global_class(directory, rrdtool, schema_cache)
+        failed = migrate(directory, node_class, rrdtool, schema_cache,
+                         workers=params['workers'], checkpoint=checkpoint)
+    finally:
+        rrdtool.close()
+
+    if not failed:
+        os.unlink(checkpoint)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    script_directory = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--nodedb', metavar='DIR',
+                        default=os.path.join(script_directory, 'nodedb'),
+                        help='directory of the RRDs (defaults to nodedb)')
+    parser.add_argument('--workers', metavar='N', type=int,
+                        default=os.cpu_count() or 1,
+                        help='upgrade up to N files at a time (defaults to '
+                             'the number of CPUs)')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='record progress in FILE (defaults to '
+                             'migrate-checkpoint.json in the nodedb '
+                             'directory), it is removed once all files are '
+                             'upgraded')
+    parser.add_argument('--rrdcached', metavar='ADDRESS',
+                        help='rrdcached backend.py hands its updates to, '
+                             'to flush them before upgrading a file')
+    parser.add_argument('--rrd-engine', choices=('rrdtool', 'array'),
+                        default='rrdtool',
+                        help='engine the RRDs were written with')
+
+    options = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    raise SystemExit(main(options))